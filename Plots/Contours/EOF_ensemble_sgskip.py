@@ -0,0 +1,297 @@
+"""
+EOF_ensemble_sgskip.py
+======================
+Compute the EOF eigenvalues of the Sea Level Pressure for several seasons and regions, with their significance.
+
+This script illustrates the following concepts:
+  - Running many EOF analyses in parallel in a process pool
+  - Sharing a large input array between processes without copying it
+  - Estimating the sampling error of eigenvalues with North's rule of thumb
+  - Estimating confidence intervals of eigenvalues by bootstrap resampling
+  - Collecting the results in a tidy xarray dataset
+
+NCL_eof_1_1.py computes the EOFs of the winter (DJF) Sea Level Pressure over
+one North Atlantic box.  Here the same analysis is run for a list of (season,
+box) combinations, and the eigenvalues of each one are recomputed for many
+bootstrap resamples of its years.  The running three-month means of the
+monthly data, from which every season is taken, are computed once and placed
+in shared memory; the analyses are then fanned out over a pool of processes,
+each process reading the seasons and boxes it needs from the shared array.
+
+This script is not run when building the gallery, because it starts a pool of
+processes.  Run it with ``python EOF_ensemble_sgskip.py``.
+"""
+
+###############################################################################
+# Import packages:
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import xarray as xr
+import numpy as np
+
+import geocat.datafiles as gdf
+import geocat.viz.util as gvutil
+
+import matplotlib.pyplot as plt
+
+###############################################################################
+# User defined parameters:
+
+yearStart = 1979
+yearEnd = 2003
+
+# (season, latS, latN, lonL, lonR) of every analysis
+specs = [
+    ('DJF', 25., 80., -70., 40.),
+    ('MAM', 25., 80., -70., 40.),
+    ('JJA', 25., 80., -70., 40.),
+    ('SON', 25., 80., -70., 40.),
+    ('DJF', 20., 70., -90., 20.),
+    ('DJF', 30., 90., -60., 60.),
+]
+
+neof = 3  # number of EOFs
+nBootstrap = 200  # number of bootstrap resamples of every analysis
+confidence = 0.95  # level of the bootstrap confidence intervals
+nWorkers = None  # number of processes, all CPUs by default
+
+# Middle month of every three-month season
+season_months = {
+    'DJF': 1,
+    'JFM': 2,
+    'FMA': 3,
+    'MAM': 4,
+    'AMJ': 5,
+    'MJJ': 6,
+    'JJA': 7,
+    'JAS': 8,
+    'ASO': 9,
+    'SON': 10,
+    'OND': 11,
+    'NDJ': 12
+}
+
+###############################################################################
+# Utility functions (run in the worker processes):
+
+# Arrays shared by the tasks of a worker process, set by init_worker()
+_worker = {}
+
+
+def init_worker(shmName, shape, months, lat, lon):
+    """ This function attaches a worker process to the shared array of running three-month means.
+    """
+    shm = shared_memory.SharedMemory(name=shmName)
+    _worker['shm'] = shm
+    _worker['means'] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    _worker.update(months=months, lat=lat, lon=lon)
+
+
+def leading_eigenvalues(x, n):
+    """ This function returns the 'n' largest eigenvalues of the covariance matrix of the (samples, points) array x,
+        and the percentages of the total variance they explain.
+    """
+    s = np.linalg.svd(x - x.mean(axis=0), compute_uv=False)
+    variance = s**2 / (len(x) - 1)
+    return variance[:n], 100 * variance[:n] / variance.sum()
+
+
+def run_task(task):
+    """ This function computes the eigenvalues of one (season, box) analysis for a range of samples: sample 0 is the
+        analysis of the actual years, and the other samples are bootstrap resamples of the years.  Every resample is
+        seeded from (seed, analysis, sample), so the results do not depend on how the tasks are scheduled.
+    """
+    index, (season, latS, latN, lonL, lonR), samples, n, seed = task
+    lat, lon = _worker['lat'], _worker['lon']
+
+    # Select the season and the box from the shared array, and weight it by sqrt(cos(lat))
+    rows = np.flatnonzero(_worker['months'] == season_months[season])
+    latMask = (lat >= latS) & (lat <= latN)
+    lonMask = (lon >= lonL) & (lon <= lonR)
+    x = _worker['means'][rows][:, latMask][:, :, lonMask]
+    x = x * np.sqrt(np.cos(np.deg2rad(lat[latMask])))[:, np.newaxis]
+    x = x.reshape(len(rows), -1)
+    x = x[:, np.isfinite(x).all(axis=0)]
+
+    results = []
+    for sample in samples:
+        if sample > 0:
+            rng = np.random.default_rng([seed, index, sample])
+            results.append(
+                leading_eigenvalues(x[rng.integers(0, len(x), len(x))], n))
+        else:
+            results.append(leading_eigenvalues(x, n))
+    return index, samples, results, len(x)
+
+
+###############################################################################
+# Utility function:
+
+
+# Define a utility function fanning out the analyses over a process pool
+def eof_ensemble(monthly,
+                 specs,
+                 neof=3,
+                 n_bootstrap=200,
+                 confidence=0.95,
+                 n_workers=None,
+                 batch_size=50,
+                 seed=0):
+    """ This function computes the EOF eigenvalues of a (time, lat, lon) data array of consecutive monthly data for
+        every (season, latS, latN, lonL, lonR) analysis of 'specs', and their significance:
+
+        - the sampling error of every eigenvalue according to North et al. (1982), eigenvalue * sqrt(2 / N) for N
+          years, and whether the eigenvalue is separated from its neighbors by more than this error;
+        - the 'confidence' intervals of the eigenvalues and of the percent variances over 'n_bootstrap' resamples of
+          the years.
+
+        Seasons are taken from running three-month means, as by month_to_season() in NCL_eof_1_1.py.  The means are
+        computed once and placed in shared memory, and the analyses are split in tasks of 'batch_size' samples run by
+        'n_workers' processes.
+
+        The results are returned as a tidy dataset with 'spec' and 'mode' dimensions.
+    """
+    means = monthly.rolling(time=3, center=True, min_periods=1).mean()
+    means = means.transpose('time', 'lat', 'lon')
+    values = means.values.astype(np.float64)
+    initargs = (means.time.dt.month.values, means.lat.values,
+                means.lon.values)
+
+    samples = range(n_bootstrap + 1)
+    tasks = [(index, spec, samples[start:start + batch_size], neof + 1, seed)
+             for index, spec in enumerate(specs)
+             for start in range(0, len(samples), batch_size)]
+    eigenvalues = np.empty((len(specs), len(samples), neof + 1))
+    pcvar = np.empty((len(specs), len(samples), neof + 1))
+    nYears = np.empty(len(specs), dtype=int)
+
+    shm = shared_memory.SharedMemory(create=True, size=values.nbytes)
+    try:
+        shared = np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = values
+        del shared, values
+
+        with ProcessPoolExecutor(n_workers,
+                                 initializer=init_worker,
+                                 initargs=(shm.name, means.shape) +
+                                 initargs) as pool:
+            for index, taskSamples, results, n in pool.map(run_task, tasks):
+                for sample, (eigenvalue, percent) in zip(taskSamples, results):
+                    eigenvalues[index, sample] = eigenvalue
+                    pcvar[index, sample] = percent
+                nYears[index] = n
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # North's rule of thumb: a mode is separated when its eigenvalue differs from its neighbors' by more than its
+    # sampling error
+    eigenvalue = eigenvalues[:, 0]
+    northError = eigenvalue * np.sqrt(2 / nYears)[:, np.newaxis]
+    gaps = eigenvalue[:, :-1] - eigenvalue[:, 1:]
+    gapAbove = np.concatenate([np.full((len(specs), 1), np.inf), gaps[:, :-1]],
+                              axis=1)
+    separated = (gapAbove > northError[:, :-1]) & (gaps > northError[:, :-1])
+
+    tail = 50 * (1 - confidence)
+    return xr.Dataset(
+        {
+            'eigenvalue': (['spec', 'mode'], eigenvalue[:, :neof]),
+            'pcvar': (['spec', 'mode'], pcvar[:, 0, :neof]),
+            'north_error': (['spec', 'mode'], northError[:, :neof]),
+            'north_separated': (['spec', 'mode'], separated),
+            'eigenvalue_low': (['spec', 'mode'],
+                               np.percentile(eigenvalues[:, 1:, :neof], tail,
+                                             axis=1)),
+            'eigenvalue_high': (['spec', 'mode'],
+                                np.percentile(eigenvalues[:, 1:, :neof],
+                                              100 - tail,
+                                              axis=1)),
+            'pcvar_low': (['spec', 'mode'],
+                          np.percentile(pcvar[:, 1:, :neof], tail, axis=1)),
+            'pcvar_high': (['spec', 'mode'],
+                           np.percentile(pcvar[:, 1:, :neof],
+                                         100 - tail,
+                                         axis=1)),
+        },
+        coords={
+            'spec': np.arange(len(specs)),
+            'mode': np.arange(1, neof + 1),
+            'season': ('spec', [spec[0] for spec in specs]),
+            'latS': ('spec', [spec[1] for spec in specs]),
+            'latN': ('spec', [spec[2] for spec in specs]),
+            'lonL': ('spec', [spec[3] for spec in specs]),
+            'lonR': ('spec', [spec[4] for spec in specs]),
+            'n_years': ('spec', nYears)
+        },
+        attrs={
+            'n_bootstrap': n_bootstrap,
+            'confidence': confidence
+        })
+
+
+###############################################################################
+# Read in data:
+
+# Open a netCDF data file using xarray default engine and load the data into xarrays
+ds = xr.open_dataset(gdf.get('netcdf_files/slp.mon.mean.nc'))
+
+# Flip longitudes to span -180 to 180 and place latitudes in increasing order, to facilitate data subsetting
+ds["lon"] = ((ds["lon"] + 180) % 360) - 180
+ds = ds.sortby("lon").sortby("lat", ascending=True)
+ds = ds.sel(time=slice(f'{yearStart}-01-01', f'{yearEnd}-12-01'))
+
+###############################################################################
+# Run the analyses:
+
+# Worker processes may import this script again, so the pool is only started from the main process
+if __name__ == '__main__':
+    result = eof_ensemble(ds.slp,
+                          specs,
+                          neof=neof,
+                          n_bootstrap=nBootstrap,
+                          confidence=confidence,
+                          n_workers=nWorkers)
+    print(result.to_dataframe())
+
+###############################################################################
+# Plot: Percent variance of every mode with its confidence interval
+
+if __name__ == '__main__':
+    fig, ax = plt.subplots(figsize=(9, 5))
+
+    labels = [
+        f'{season}\nlat {latS:g} to {latN:g}\nlon {lonL:g} to {lonR:g}'
+        for season, latS, latN, lonL, lonR in specs
+    ]
+    x = np.arange(len(specs))
+    for i, mode in enumerate(result.mode.values):
+        modeResult = result.sel(mode=mode)
+        ax.errorbar(x + 0.2 * (i - 1),
+                    modeResult.pcvar,
+                    yerr=[
+                        modeResult.pcvar - modeResult.pcvar_low,
+                        modeResult.pcvar_high - modeResult.pcvar
+                    ],
+                    fmt='o',
+                    capsize=3,
+                    label=f'EOF {mode}')
+    ax.legend(frameon=False)
+
+    # Use geocat.viz.util convenience function to add minor and major tick lines
+    gvutil.add_major_minor_ticks(ax, x_minor_per_major=1, labelsize=10)
+    ax.set_xticks(x)
+    ax.set_xticklabels(labels)
+
+    # Use geocat.viz.util convenience function to set titles and labels
+    gvutil.set_titles_and_labels(
+        ax,
+        maintitle=f'SLP EOFs: {yearStart}-{yearEnd}',
+        maintitlefontsize=14,
+        ylabel=f'Variance explained (%), {100 * confidence:g}% interval',
+        labelfontsize=12)
+
+    # Show the plot
+    plt.tight_layout()
+    plt.show()
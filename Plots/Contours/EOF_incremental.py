@@ -0,0 +1,260 @@
+"""
+EOF_incremental.py
+==================
+Update the EOFs of the North Atlantic Sea Level Pressure as new months arrive.
+
+This script illustrates the following concepts:
+  - Storing an EOF decomposition on disk and updating it with new time steps
+  - Updating a truncated SVD with a rank update instead of recomputing it
+  - Measuring the drift of the updated EOFs from a full recomputation
+  - Drawing a time series plot
+
+NCL_eof_1_1.py computes the EOFs of a complete data set at once.  When the
+EOFs are refreshed every month, one new time slice at a time, recomputing the
+whole decomposition costs as much as the full record.  Here the decomposition
+is kept on disk as its state: the number of samples, the time mean, the
+leading right singular vectors (the spatial basis) and the singular values of
+the anomalies.  A new month is folded into the state with the rank update of
+the incremental PCA (Ross et al., 2008), which decomposes a matrix of only
+``rank + new months + 1`` rows, so that a refresh costs about the size of the
+new data.
+
+Because the state is truncated to ``rank`` vectors, the updated EOFs slowly
+drift from those of a full recomputation.  The drift is measured here after
+every update; operationally it can be checked from time to time, and the state
+rebuilt with ``init_eof_state`` when it grows too large.
+"""
+
+###############################################################################
+# Import packages:
+import os
+import tempfile
+
+import xarray as xr
+import numpy as np
+
+import geocat.datafiles as gdf
+import geocat.viz.util as gvutil
+
+import matplotlib.pyplot as plt
+
+###############################################################################
+# User defined parameters:
+
+# In order to specify region of the globe, time span, etc.
+latS = 25.
+latN = 80.
+lonL = -70.
+lonR = 40.
+
+# The initial decomposition covers these years; the months of updateYear are then appended one at a time
+yearStart = 1979
+yearEnd = 2002
+updateYear = 2003
+
+neof = 3  # number of EOFs
+rank = 20  # number of singular vectors kept in the state
+
+# File holding the decomposition state, in a temporary directory removed at the end of the script.  Point it to a
+# persistent location for operational updates.
+stateDir = tempfile.TemporaryDirectory()
+statePath = os.path.join(stateDir.name, 'slp_eof_state.nc')
+
+###############################################################################
+# Read in data:
+
+# Open a netCDF data file using xarray default engine and load the data into xarrays
+ds = xr.open_dataset(gdf.get('netcdf_files/slp.mon.mean.nc'))
+
+# Flip longitudes to span -180 to 180 and place latitudes in increasing order, to facilitate data subsetting
+ds["lon"] = ((ds["lon"] + 180) % 360) - 180
+ds = ds.sortby("lon").sortby("lat", ascending=True)
+
+# Subset data to the North Atlantic region and the years used
+slp = ds.slp.sel(lat=slice(latS, latN),
+                 lon=slice(lonL, lonR),
+                 time=slice(f'{yearStart}-01-01', f'{updateYear}-12-01'))
+
+# Remove the seasonal cycle with the monthly climatology of the initial years
+climatology = slp.sel(time=slice(f'{yearStart}-01-01', f'{yearEnd}-12-01'))
+climatology = climatology.groupby('time.month').mean('time')
+anomalies = slp.groupby('time.month') - climatology
+
+###############################################################################
+# Weight the anomalies:
+
+# Weight by sqrt(cos(lat)), so that the EOFs are those of the area-weighted covariance; the weights along lat
+# broadcast against the (time, lat, lon) anomalies
+x = anomalies * np.sqrt(np.cos(np.deg2rad(anomalies['lat'].astype(np.float64))))
+
+###############################################################################
+# Utility functions:
+
+
+# Define utility functions for creating, updating and storing the decomposition state
+def init_eof_state(data, rank):
+    """ This function computes the state of the EOF decomposition of a (time, lat, lon) data array: the number of
+        samples, the time mean, the 'rank' leading right singular vectors of the anomalies and their singular values,
+        as well as the sum of squares of the anomalies (their total variance times the number of samples minus one).
+    """
+    values = data.values.reshape(data.sizes['time'], -1).astype(np.float64)
+    mean = values.mean(axis=0)
+    _, s, vt = np.linalg.svd(values - mean, full_matrices=False)
+    return make_eof_state(data, len(values), mean, vt[:rank], s[:rank],
+                          np.sum((values - mean)**2))
+
+
+def make_eof_state(data, n_samples, mean, basis, singular_values, sum_squares):
+    """ This function wraps the arrays of a decomposition state in an xarray dataset with the coordinates of data.
+    """
+    space = [data['lat'], data['lon']]
+    shape = [data.sizes['lat'], data.sizes['lon']]
+    return xr.Dataset(
+        {
+            'mean': (['lat', 'lon'], mean.reshape(shape)),
+            'basis': (['mode', 'lat', 'lon'], basis.reshape([-1] + shape)),
+            'singular_values': (['mode'], singular_values)
+        },
+        coords={
+            'mode': np.arange(len(singular_values)),
+            'lat': space[0],
+            'lon': space[1]
+        },
+        attrs={
+            'n_samples': n_samples,
+            'sum_squares': sum_squares,
+            'last_time': str(data['time'][-1].values)
+        })
+
+
+def update_eof_state(state, data):
+    """ This function folds the new time steps of a (time, lat, lon) data array into a decomposition state.
+
+        The state is the truncated SVD of the n anomalies seen so far.  With the m new time steps, centered on their
+        own mean, and a correction row accounting for the shift of the mean, the SVD of the stacked matrix
+
+            [ singular_values * basis                      ]  (rank rows)
+            [ new values - new mean                        ]  (m rows)
+            [ sqrt(n m / (n + m)) (old mean - new mean)    ]  (1 row)
+
+        is the SVD of all n + m anomalies, up to the truncation of the previous state.  Its cost only depends on rank
+        and m, not on n.
+    """
+    values = data.values.reshape(data.sizes['time'], -1).astype(np.float64)
+    n, m = state.attrs['n_samples'], len(values)
+    mean = state['mean'].values.ravel()
+    basis = state['basis'].values.reshape(state.sizes['mode'], -1)
+    s = state['singular_values'].values
+
+    newMean = values.mean(axis=0)
+    correction = np.sqrt(n * m / (n + m)) * (mean - newMean)
+    stack = np.vstack([s[:, np.newaxis] * basis, values - newMean, correction])
+    _, sNew, vtNew = np.linalg.svd(stack, full_matrices=False)
+    rank = len(s)
+    sNew, vtNew = sNew[:rank], vtNew[:rank]
+
+    # Keep the signs of the previous basis, so that the time series stay continuous
+    sign = np.sign(np.sum(vtNew * basis, axis=1))
+    vtNew *= np.where(sign == 0, 1, sign)[:, np.newaxis]
+
+    # Combine the sums of squares of the two sets of samples (Chan et al., 1979)
+    sumSquares = (state.attrs['sum_squares'] + np.sum((values - newMean)**2) +
+                  n * m / (n + m) * np.sum((mean - newMean)**2))
+
+    return make_eof_state(data, n + m, (n * mean + m * newMean) / (n + m),
+                          vtNew, sNew, sumSquares)
+
+
+def save_eof_state(state, path):
+    """ This function writes a decomposition state to a netCDF file, replacing the previous state only once the new
+        one is completely written.
+    """
+    state.to_netcdf(path + '.partial')
+    os.replace(path + '.partial', path)
+
+
+def eofs_from_state(state, neof):
+    """ This function returns the leading EOFs of a decomposition state, with the 'evn' dimension and the 'eigenvalues'
+        and 'pcvar' attributes of the output of geocat.comp's eofunc.
+    """
+    s = state['singular_values'].values[:neof]
+    eof = state['basis'].isel(mode=slice(0, neof)).rename(mode='evn')
+    eof.attrs = {
+        'eigenvalues': s**2 / (state.attrs['n_samples'] - 1),
+        'pcvar': 100 * s**2 / state.attrs['sum_squares'],
+        'matrix': 'covariance',
+        'method': 'incremental'
+    }
+    return eof
+
+
+def eof_drift(state, data, neof):
+    """ This function recomputes the EOFs of all the time steps of data and returns, for each of the leading 'neof'
+        EOFs of a decomposition state, the angle in degrees between the EOF of the state and the recomputed one, and
+        the relative difference of their percent variances.
+    """
+    full = init_eof_state(data, neof)
+    eof = eofs_from_state(state, neof)
+    fullEof = eofs_from_state(full, neof)
+    cosine = np.abs(
+        np.sum(eof.values.reshape(neof, -1) * fullEof.values.reshape(neof, -1),
+               axis=1))
+    angle = np.rad2deg(np.arccos(np.clip(cosine, 0, 1)))
+    pcvarError = eof.pcvar / fullEof.pcvar - 1
+    return angle, pcvarError
+
+
+###############################################################################
+# Compute the initial state and update it with every new month:
+
+initial = x.sel(time=slice(f'{yearStart}-01-01', f'{yearEnd}-12-01'))
+save_eof_state(init_eof_state(initial, rank), statePath)
+
+newMonths = x.sel(time=slice(f'{updateYear}-01-01', f'{updateYear}-12-01'))
+angles = []
+for i in range(newMonths.sizes['time']):
+    # Every refresh only reads the stored state and the new month
+    state = xr.load_dataset(statePath)
+    state = update_eof_state(state, newMonths.isel(time=slice(i, i + 1)))
+    save_eof_state(state, statePath)
+
+    # Report the drift from a full recomputation over all the months seen so far
+    seen = x.sel(time=slice(None, state.attrs['last_time']))
+    angle, pcvarError = eof_drift(state, seen, neof)
+    angles.append(angle)
+    print(f"{state.attrs['last_time'][:7]}: drift " +
+          ', '.join(f'EOF {j + 1} {angle[j]:.3f} deg ({100 * pcvarError[j]:+.2f}% pcvar)'
+                    for j in range(neof)))
+
+angles = np.array(angles)
+
+# Remove the temporary state
+stateDir.cleanup()
+
+###############################################################################
+# Plot: Drift of the updated EOFs from a full recomputation
+
+fig, ax = plt.subplots(figsize=(7, 4.5))
+
+months = newMonths.time.dt.month
+for i in range(neof):
+    ax.plot(months, angles[:, i], marker='o', label=f'EOF {i + 1}')
+ax.legend(loc='upper left', frameon=False)
+
+# Use geocat.viz.util convenience function to add minor and major tick lines
+gvutil.add_major_minor_ticks(ax, x_minor_per_major=1, labelsize=10)
+
+# Use geocat.viz.util convenience function to set axes tick values
+gvutil.set_axes_limits_and_ticks(ax, xlim=[0.5, 12.5], xticks=np.arange(1, 13))
+
+# Use geocat.viz.util convenience function to set titles and labels
+gvutil.set_titles_and_labels(ax,
+                             maintitle=f'SLP EOFs updated monthly in {updateYear}',
+                             maintitlefontsize=14,
+                             xlabel='Month appended',
+                             ylabel='Angle to full recompute (degrees)',
+                             labelfontsize=12)
+
+# Show the plot
+plt.tight_layout()
+plt.show()
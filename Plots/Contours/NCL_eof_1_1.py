@@ -5,6 +5,7 @@ Calculate EOFs of the Sea Level Pressure over the North Atlantic.
 
 This script illustrates the following concepts:
   - Calculating EOFs
+  - Calculating EOFs of a field too large for memory, reading it in chunks along time
   - Drawing a time series plot
   - Using coordinate subscripting to read a specified geographical region
   - Rearranging longitude data to span -180 to 180
@@ -26,6 +27,8 @@ Note (2):
 
 ###############################################################################
 # Import packages:
+import weakref
+
 import xarray as xr
 import numpy as np
 
@@ -52,6 +55,11 @@ yearEnd = 2003
 
 neof = 3  # number of EOFs
 
+# Set to True to compute the EOFs with a randomized decomposition that reads the data in chunks of "chunkSize" time
+# steps, so that fields too large for memory (e.g. daily, high resolution, multi-decade data) can be analyzed
+streamEOF = False
+chunkSize = 10
+
 # Set to True to activate diagnostic print statements throughout the code
 debug = False
 
@@ -114,6 +122,51 @@ print_debug(ds)
 # Utility function:
 
 
+# Middle month of every three-month season
+season_months = {
+    'DJF': 1,
+    'JFM': 2,
+    'FMA': 3,
+    'MAM': 4,
+    'AMJ': 5,
+    'MJJ': 6,
+    'JJA': 7,
+    'JAS': 8,
+    'ASO': 9,
+    'SON': 10,
+    'OND': 11,
+    'NDJ': 12
+}
+
+# Running three-month means of the monthly datasets passed to month_to_season(), keyed by dataset id.  The weak
+# reference stored with them checks that the id still belongs to the same dataset.
+_seasonal_means = {}
+
+
+# Define a utility function for computing the means of all twelve seasons at once
+def seasonal_means(xMon):
+    """ This function takes an xarray dataset containing consecutive monthly data and returns the dataset of the
+        running three-month means: each time stamp holds the mean of its month and of the months before and after it,
+        i.e. the mean of the season centered on that month.  All twelve seasons are computed in a single strided pass
+        over the month axis.
+
+        At the ends of the time range, the mean is taken over the available months only, e.g. the first time stamp
+        holds the mean of the first two months.
+
+        Results are cached per dataset, so asking for several seasons of the same (unmodified) dataset computes the
+        running means once.
+    """
+    key = id(xMon)
+    if key in _seasonal_means:
+        ref, xSeasons = _seasonal_means[key]
+        if ref() is xMon:
+            return xSeasons
+
+    xSeasons = xMon.rolling(time=3, center=True, min_periods=1).mean()
+    _seasonal_means[key] = (weakref.ref(xMon), xSeasons)
+    return xSeasons
+
+
 # Define a utility function for computing seasonal means (to mimmic NCL's month_to_season())
 def month_to_season(xMon, season):
     """ This function takes an xarray dataset containing monthly data spanning years and
@@ -125,35 +178,16 @@ def month_to_season(xMon, season):
         is dropped.  For example, if the monthly data's time range is [Jan-2000, Dec-2003] and the season is "DJF", the
         seasonal mean computed from the single month of Dec-2003 is dropped.
     """
-    startDate = xMon.time[0]
-    endDate = xMon.time[-1]
-    seasons_pd = {
-        'DJF': ('QS-DEC', 1),
-        'JFM': ('QS-JAN', 2),
-        'FMA': ('QS-FEB', 3),
-        'MAM': ('QS-MAR', 4),
-        'AMJ': ('QS-APR', 5),
-        'MJJ': ('QS-MAY', 6),
-        'JJA': ('QS-JUN', 7),
-        'JAS': ('QS-JUL', 8),
-        'ASO': ('QS-AUG', 9),
-        'SON': ('QS-SEP', 10),
-        'OND': ('QS-OCT', 11),
-        'NDJ': ('QS-NOV', 12)
-    }
     try:
-        (season_pd, season_sel) = seasons_pd[season]
+        season_sel = season_months[season]
     except KeyError:
         raise ValueError("contributed: month_to_season: bad season: SEASON = " +
                          season)
 
-    # Compute the three-month means, moving time labels ahead to the middle month.
-    month_offset = 'MS'
-    xSeasons = xMon.resample(time=season_pd, loffset=month_offset).mean()
-
-    # Filter just the desired season, and trim to the desired time range.
+    # Filter just the desired season from the running means of all seasons. Seasons centered outside of the time range
+    # have no time stamp, so they are dropped.
+    xSeasons = seasonal_means(xMon)
     xSea = xSeasons.sel(time=xSeasons.time.dt.month == season_sel)
-    xSea = xSea.sel(time=slice(startDate, endDate))
     return xSea
 
 
@@ -202,16 +236,102 @@ xw = wSLP.sel(lat=slice(latS, latN), lon=slice(lonL, lonR))
 print_debug('\n\nxw:\n\n')
 print_debug(xw.slp)
 
+###############################################################################
+# Utility function:
+
+
+# Define a utility function for computing EOFs without loading the whole field in memory
+def streaming_eofunc(data, neof, chunk_size=10, oversample=10, n_power_iter=2, seed=0):
+    """ This function computes the leading EOFs of an xarray data array with a time dimension, and their time series,
+        reading the data in chunks of 'chunk_size' time steps.  Only the time mean, a few basis vectors of the spatial
+        domain and the (time, basis) projection of the data are kept in memory.
+
+        The EOFs are the eigenvectors of the covariance matrix of the anomalies, found with a randomized range finder
+        (Halko et al., 2011): the anomalies are multiplied by a random basis of 'neof + oversample' vectors, refined by
+        'n_power_iter' power iterations, and the small projection of the anomalies onto this basis is decomposed
+        exactly. Every step is a sum over chunks of time steps, so the data are read 'n_power_iter + 3' times.
+
+        The results have the structure of the outputs of geocat.comp's eofunc and eofunc_ts (with meta=True): EOFs
+        with an 'evn' dimension and the 'eigenvalues' and 'pcvar' (percent variance) attributes, and time series of the
+        anomalies with a 'neval' dimension and a 'ts_mean' attribute. Points with missing values are excluded and set
+        to NaN in the EOFs. The sign of every EOF is chosen so that its largest component is positive.
+    """
+    space_dims = [dim for dim in data.dims if dim != 'time']
+    space_shape = [data.sizes[dim] for dim in space_dims]
+    data = data.transpose('time', *space_dims)
+    nTime = data.sizes['time']
+
+    def chunks():
+        for start in range(0, nTime, chunk_size):
+            x = data.isel(time=slice(start, start + chunk_size)).values
+            yield start, x.reshape(len(x), -1).astype(np.float64)
+
+    # Pass 1: time mean of the points that are valid at every time step
+    total = 0.
+    valid = True
+    for _, x in chunks():
+        total = total + x.sum(axis=0)
+        valid = valid & np.isfinite(x).all(axis=0)
+    mean = total[valid] / nTime
+
+    def anomalies():
+        for start, x in chunks():
+            yield start, x[:, valid] - mean
+
+    # Randomized range finder: an orthonormal basis of the leading eigenvectors of the covariance X^T X
+    rank = min(neof + oversample, nTime, mean.size)
+    basis = np.random.default_rng(seed).standard_normal((mean.size, rank))
+    for _ in range(n_power_iter + 1):
+        basis, _ = np.linalg.qr(basis)
+        product = np.zeros_like(basis)
+        for _, x in anomalies():
+            product += x.T @ (x @ basis)
+        basis = product
+    basis, _ = np.linalg.qr(basis)
+
+    # Final pass: project the anomalies onto the basis and sum their total variance
+    projected = np.empty((nTime, rank))
+    sumSquares = 0.
+    for start, x in anomalies():
+        projected[start:start + len(x)] = x @ basis
+        sumSquares += np.sum(x**2)
+
+    # The exact SVD of the small projection gives the EOFs and their time series
+    u, s, vt = np.linalg.svd(projected, full_matrices=False)
+    eofs = vt[:neof] @ basis.T
+    pcs = u[:, :neof] * s[:neof]
+    sign = np.sign(eofs[np.arange(neof), np.abs(eofs).argmax(axis=1)])
+    eofs *= sign[:, np.newaxis]
+    pcs *= sign
+
+    field = np.full((neof, valid.size), np.nan)
+    field[:, valid] = eofs
+    eof = xr.DataArray(field.reshape([neof] + space_shape),
+                       dims=['evn'] + space_dims,
+                       coords={'evn': np.arange(neof), **{dim: data[dim] for dim in space_dims}},
+                       attrs={'eigenvalues': s[:neof]**2 / (nTime - 1),
+                              'pcvar': 100 * s[:neof]**2 / sumSquares,
+                              'matrix': 'covariance',
+                              'method': 'randomized'})
+    eof_ts = xr.DataArray(pcs.T,
+                          dims=['neval', 'time'],
+                          coords={'neval': np.arange(neof), 'time': data['time']},
+                          attrs={'ts_mean': eofs @ mean})
+    return eof, eof_ts
+
+
 ###############################################################################
 # Compute the EOFs:
 
-eof = eofunc(xw["slp"], neof, time_dim=1, meta=True)
+if streamEOF:
+    eof, eof_ts = streaming_eofunc(xw["slp"], neof, chunk_size=chunkSize)
+else:
+    eof = eofunc(xw["slp"], neof, time_dim=1, meta=True)
+    eof_ts = eofunc_ts(xw["slp"], eof, time_dim=1, meta=True)
 
 print_debug('\n\neof:\n\n')
 print_debug(eof)
 
-eof_ts = eofunc_ts(xw["slp"], eof, time_dim=1, meta=True)
-
 print_debug('\n\neof_ts:\n\n')
 print_debug(eof_ts)
 
@@ -19,7 +19,10 @@ import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import numpy as np
-from sklearn.cluster import DBSCAN
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import warnings
 
 import geocat.datafiles as gdf
@@ -48,14 +51,24 @@ wrap_pressure = gvutil.xr_add_cyclic_longitudes(pressure, "lon")
 # Define a helper function to find local extrema
 
 
-def findLocalExtrema(da, highVal=0, lowVal=1000, eType='Low'):
+def findLocalExtrema(da, highVal=0, lowVal=1000, eType='Low', radius=10):
     """
     Utility function to find local low/high field variable coordinates on a contour map. To classify as a local high, the data
     point must be greater than highVal, and to classify as a local low, the data point must be less than lowVal.
 
+    Candidates are the points lower (higher) than their eight neighbors, found for the whole grid at once with a minimum
+    (maximum) filter. Candidates closer than 'radius' degrees along a great circle are clustered together, using a KD-tree
+    of their positions on the unit sphere, and the lowest (highest) candidate of each cluster is kept. Distances are thus
+    correct near the poles and across the dateline, and the duplicated longitude of cyclic data (0 and 360 degrees) falls
+    in the same cluster.
+
+    Fields with leading dimensions (e.g. time, lat, lon) are searched in the same call, every field of the leading
+    dimensions (e.g. every time step) independently of the others.
+
     Args:
         da: (:class:`xarray.DataArray`):
-            Xarray data array containing the lat, lon, and field variable (ex. pressure) data values
+            Xarray data array containing the lat, lon, and field variable (ex. pressure) data values, with lat and lon
+            as its last two dimensions
         highVal (:class:`int`):
             Data value that the local high must be greater than to qualify as a "local high" location.
             Default highVal is 0.
@@ -66,82 +79,73 @@ def findLocalExtrema(da, highVal=0, lowVal=1000, eType='Low'):
             'Low' or 'High'
             Determines which extrema are being found- minimum or maximum, respectively.
             Default eType is 'Low'.
+        radius (:class:`float`):
+            Great circle distance in degrees within which only one local extremum is kept.
+            Default radius is 10.
     Returns:
-        clusterExtremas (:class:`list`):
-            List of coordinate tuples in GPS form (lon in degrees, lat in degrees)
-            that specify local low/high locations
+        extremas (:class:`list`):
+            List of tuples (indices along the leading dimensions, if any, lon in degrees, lat in degrees, data value)
+            that specify local low/high locations and values, in the order of the leading indices
     """
 
-    # Create a 2D array of coordinates in the same shape as the field variable data
-    # so each coordinate is easily mappable to a data value
-    # ex:
-    # (1, 1), (2, 1), (3, 1)
-    # (1, 2)................
-    # (1, 3)................
-    lons, lats = np.meshgrid(np.array(da.lon), np.array(da.lat))
-    coordarr = np.dstack((lons, lats))
-
-    # Find all zeroes that also qualify as low or high values
-    extremacoords = []
+    lons = np.asarray(da.lon)
+    lats = np.asarray(da.lat)
+    data = np.asarray(da.data, dtype='float64')
 
+    # Search maxima of the negated field for lows, so that both types of extrema share the code below.
+    # Missing values can never be extrema.
     if eType == 'Low':
-        coordlist = np.argwhere(da.data < lowVal)
-        extremacoords = [tuple(coordarr[x[0]][x[1]]) for x in coordlist]
+        field = np.where(np.isnan(data), -np.inf, -data)
+        threshold = -lowVal
     if eType == 'High':
-        coordlist = np.argwhere(da.data < lowVal)
-        extremacoords = [tuple(coordarr[x[0]][x[1]]) for x in coordlist]
+        field = np.where(np.isnan(data), -np.inf, data)
+        threshold = highVal
 
-    if extremacoords == []:
+    # Global grids wrap around in longitude
+    cyclic = np.isclose(abs(lons[1] - lons[0]) * lons.size, 360)
+
+    # Find the points holding the largest value of their 3x3 neighborhood, in every field of the leading dimensions
+    leading = data.ndim - 2
+    neighborhoodMax = ndimage.maximum_filter(
+        field,
+        size=(1,) * leading + (3, 3),
+        mode=('nearest',) * (leading + 1) + ('wrap' if cyclic else 'nearest',))
+    *indices, y, x = np.nonzero((field == neighborhoodMax) & (field > threshold))
+
+    if y.size == 0:
         if eType == 'Low':
             warnings.warn(
                 'No local extrema with data value less than given lowVal')
-            return []
         if eType == 'High':
             warnings.warn(
                 'No local extrema with data value greater than given highVal')
-            return []
-
-    # Clean up noisy data to find actual extrema
-
-    # Use Density-based spatial clustering of applications with noise
-    # to cluster and label coordinates
-    db = DBSCAN(eps=10, min_samples=1)
-    new = db.fit(extremacoords)
-    labels = new.labels_
-
-    # Create an dictionary of values with key being coordinate
-    # and value being cluster label.
-    coordsAndLabels = {label: [] for label in labels}
-    for label, coord in zip(labels, extremacoords):
-        coordsAndLabels[label].append(coord)
-
-    # Initialize array of coordinates to be returned
-    clusterExtremas = []
-
-    # Iterate through the coordinates in each cluster
-    for key in coordsAndLabels:
-
-        # Create array to hold all the field variable values for that cluster
-        datavals = []
-        for coord in coordsAndLabels[key]:
-
-            # Find pressure data at that coordinate
-            cond = np.logical_and(coordarr[:, :, 0] == coord[0],
-                                  coordarr[:, :, 1] == coord[1])
-            x, y = np.where(cond)
-            datavals.append(da.data[x[0]][y[0]])
-
-        # Find the index of the smallest/greatest field variable value of each cluster
-        if eType == 'Low':
-            index = np.argmin(np.array(datavals))
-        if eType == 'High':
-            index = np.argmax(np.array(datavals))
-
-        # Append the coordinate corresponding to that index to the array to be returned
-        clusterExtremas.append(
-            (coordsAndLabels[key][index][0], coordsAndLabels[key][index][1]))
-
-    return clusterExtremas
+        return []
+
+    # Cluster the candidates closer than 'radius' on the unit sphere; the chord between two unit vectors is
+    # 2 * sin(angle / 2), at most 2, so a coordinate spaced by 10 between the fields of the leading dimensions never
+    # lets two fields share a cluster
+    fieldIndex = np.ravel_multi_index(indices,
+                                      data.shape[:leading]) if leading else 0
+    lonRad, latRad = np.deg2rad(lons[x]), np.deg2rad(lats[y])
+    xyz = np.column_stack((np.cos(latRad) * np.cos(lonRad),
+                           np.cos(latRad) * np.sin(lonRad), np.sin(latRad),
+                           np.broadcast_to(10.0 * fieldIndex, y.shape)))
+    pairs = cKDTree(xyz).query_pairs(2 * np.sin(np.deg2rad(radius) / 2),
+                                     output_type='ndarray').reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(y.size, y.size))
+    _, clusters = connected_components(graph, directed=False)
+
+    # Keep the largest value of every cluster, in the order of the leading indices
+    values = data[tuple(indices) + (y, x)]
+    order = np.argsort(values if eType == 'Low' else -values, kind='stable')
+    _, first = np.unique(clusters[order], return_index=True)
+    best = np.sort(order[first])
+
+    return [
+        tuple(int(index[i]) for index in indices) +
+        (float(lons[x[i]]), float(lats[y[i]]), float(values[i])) for i in best
+    ]
 
 
 ###############################################################################
@@ -160,7 +164,7 @@ def plotCLabels(da,
     """
     Utility function to plot contour labels by passing in a coordinate to the clabel function.
     This allows the user to specify the exact locations of the labels, rather than having matplotlib
-    plot them automatically.
+    plot them automatically. All the locations are projected in one call before being passed to clabel.
 
     Args:
         da: (:class:`xarray.DataArray`):
@@ -194,12 +198,14 @@ def plotCLabels(da,
 
     # Plot any regular contour levels
     if clabel_locations != []:
+
+        # Project all label locations at once, and skip those that are not visible in the projection
         clevelpoints = proj.transform_points(
             transform, np.array([x[0] for x in clabel_locations]),
-            np.array([x[1] for x in clabel_locations]))
-        transformed_locations = [(x[0], x[1]) for x in clevelpoints]
+            np.array([x[1] for x in clabel_locations]))[:, :2]
+        clevelpoints = clevelpoints[np.isfinite(clevelpoints).all(axis=1)]
         ax.clabel(contours,
-                  manual=transformed_locations,
+                  manual=clevelpoints,
                   inline=True,
                   fontsize=fontsize,
                   colors='black',
@@ -222,8 +228,7 @@ def plotCLabels(da,
 # Define a helper function that will plot contour labels
 
 
-def plotELabels(da,
-                contours,
+def plotELabels(contours,
                 transform,
                 ax,
                 proj,
@@ -237,8 +242,6 @@ def plotELabels(da,
     and placement.
 
     Args:
-        da: (:class:`xarray.DataArray`):
-            Xarray data array containing the lat, lon, and field variable data values.
         contours (:class:`cartopy.mpl.contour.GeoContourSet`):
             Contour set that is being labeled.
         transform (:class:`cartopy._crs`):
@@ -250,8 +253,8 @@ def plotELabels(da,
             Projection 'ax' is defined by.
             This is the instaance of CRS that the coordinates will be transformed to.
         clabel_locations (:class:`list`):
-            List of coordinate tuples in GPS form (lon in degrees, lat in degrees)
-            that specify where the contour labels should be plotted.
+            List of tuples (lon in degrees, lat in degrees, data value), as returned by findLocalExtrema,
+            that specify where the contour labels should be plotted and their values.
         type (:class:`list`):
             'high' or 'low'
             High contour labels will be plotted with an H
@@ -267,56 +270,38 @@ def plotELabels(da,
             List of text instances of all contour labels
     """
 
-    # Create array of coordinates in the same shape as field variable data
-    # so each coordinate can be easily mapped to its data value.
-    # ex:
-    # (1, 1), (2, 1), (3, 1)
-    # (1, 2)................
-    # (1, 3)................
-    lons, lats = np.meshgrid(np.array(da.lon), np.array(da.lat))
-    coordarr = np.dstack((lons, lats))
-
     # Initialize empty array that will be filled with contour label text objects and returned
     extremaLabels = []
 
-    # Plot any low contour levels
+    # Transform all the label locations at once
     clabel_points = proj.transform_points(
         transform, np.array([x[0] for x in clabel_locations]),
         np.array([x[1] for x in clabel_locations]))
-    transformed_locations = [(x[0], x[1]) for x in clabel_points]
-
-    for x in range(len(transformed_locations)):
-
-        try:
-            # Find field variable data at that coordinate
-            coord = clabel_locations[x]
-            cond = np.logical_and(coordarr[:, :, 0] == coord[0],
-                                  coordarr[:, :, 1] == coord[1])
-            z, y = np.where(cond)
-            p = int(round(da.data[z[0]][y[0]]))
-
-            if eType == 'High':
-                lab = plt.text(transformed_locations[x][0],
-                               transformed_locations[x][1],
-                               "H$_{" + str(p) + "}$",
-                               fontsize=fontsize,
-                               horizontalalignment='center',
-                               verticalalignment='center')
-            elif eType == 'Low':
-                lab = plt.text(transformed_locations[x][0],
-                               transformed_locations[x][1],
-                               "L$_{" + str(p) + "}$",
-                               fontsize=fontsize,
-                               horizontalalignment='center',
-                               verticalalignment='center')
-
-            if horizontal is True:
-                lab.set_rotation('horizontal')
-
-            extremaLabels.append(lab)
-
-        except:
-            continue
+
+    for point, (lon, lat, value) in zip(clabel_points, clabel_locations):
+
+        # The field variable value was found together with the location
+        p = int(round(value))
+
+        if eType == 'High':
+            lab = plt.text(point[0],
+                           point[1],
+                           "H$_{" + str(p) + "}$",
+                           fontsize=fontsize,
+                           horizontalalignment='center',
+                           verticalalignment='center')
+        elif eType == 'Low':
+            lab = plt.text(point[0],
+                           point[1],
+                           "L$_{" + str(p) + "}$",
+                           fontsize=fontsize,
+                           horizontalalignment='center',
+                           verticalalignment='center')
+
+        if horizontal is True:
+            lab.set_rotation('horizontal')
+
+        extremaLabels.append(lab)
 
     if whitebbox is True:
         [
@@ -384,8 +369,7 @@ plotCLabels(pressure,
             ax,
             proj,
             clabel_locations=regularCLabels)
-plotELabels(pressure,
-            p,
+plotELabels(p,
             ccrs.Geodetic(),
             ax,
             proj,
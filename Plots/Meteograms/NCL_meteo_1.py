@@ -12,6 +12,7 @@ This script illustrates the following concepts:
    - Drawing a bar chart
    - Changing the width and height of a plot
    - Overlaying wind barbs and line contours on filled contours
+   - Placing contour labels automatically without overlaps
    - Changing the position of individual plots on a page
 
 See following URLs to see the reproduced NCL plot & script:
@@ -24,7 +25,10 @@ See following URLs to see the reproduced NCL plot & script:
 import xarray as xr
 import numpy as np
 from matplotlib import pyplot as plt
+import matplotlib.path as mpath
 from matplotlib.colors import ListedColormap, BoundaryNorm
+from matplotlib.collections import Collection
+from matplotlib.font_manager import FontProperties
 import cartopy.crs as ccrs
 
 import geocat.datafiles as gdf
@@ -46,6 +50,128 @@ vgrid = ds.vgrid
 rain03 = ds.rain03
 tempht = ds.tempht
 
+###############################################################################
+# Define a helper function to lay out contour labels
+
+
+def add_contour_labels(ax,
+                       contours,
+                       levels=None,
+                       fontsize=10,
+                       fmt='%d',
+                       spacing=150,
+                       occupied=None,
+                       **kwargs):
+    """
+    Utility function to label contours without overlaps. Every label is drawn directly as a text rotated along its
+    contour line, at the vertex where the line is straightest over the width of the label, provided that the label
+    is further than 'spacing' pixels along the line from the other labels of that line and does not overlap any
+    label box in 'occupied'.
+
+    Args:
+        ax (:class:`matplotlib.axes.Axes`):
+            Axis containing the contour set.
+        contours (:class:`matplotlib.contour.QuadContourSet`):
+            Contour set that is being labeled.
+        levels (:class:`list`):
+            Contour levels to label; all levels by default.
+        fontsize (:class:`int` or :class:`str`):
+            Font size of the contour labels.
+        fmt (:class:`str`):
+            Format of the contour labels.
+        spacing (:class:`float`):
+            Smallest distance in pixels between two labels of the same contour line.
+        occupied (:class:`list`):
+            Pixel boxes (x0, y0, x1, y1) of the labels already placed, extended in place.
+        **kwargs:
+            Other keyword arguments of the label texts (color, bbox, zorder...).
+    Returns:
+        labels (:class:`list`):
+            List of text instances of all contour labels
+    """
+
+    if occupied is None:
+        occupied = []
+
+    # Work in pixels, with the final axes position
+    ax.apply_aspect()
+    height = FontProperties(size=fontsize).get_size_in_points()
+    height *= ax.figure.dpi / 72
+    toPixels = contours.get_transform()
+    toData = ax.transData.inverted()
+
+    # Paths of every level: a collection per level before matplotlib 3.8, a single path per level since then
+    if isinstance(contours, Collection):
+        levelPaths = [[path] for path in contours.get_paths()]
+    else:
+        levelPaths = [
+            collection.get_paths() for collection in contours.collections
+        ]
+
+    labels = []
+    for level, paths in zip(contours.levels, levelPaths):
+        if levels is not None and level not in levels:
+            continue
+        text = fmt % level
+        halfWidth = 0.3 * height * len(text)
+        for path in paths:
+            vertices, codes = path.vertices, path.codes
+            if codes is not None:
+                keep = codes != mpath.Path.CLOSEPOLY
+                vertices, codes = vertices[keep], codes[keep]
+            splits = ([] if codes is None else
+                      np.flatnonzero(codes == mpath.Path.MOVETO)[1:])
+            for line in np.split(vertices, splits):
+                if len(line) < 2:
+                    continue
+                xy = toPixels.transform(line)
+                arc = np.concatenate(
+                    ([0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))
+
+                # Straightness of the line over the width of a label centered on every vertex
+                start = np.searchsorted(arc, arc - halfWidth)
+                end = np.searchsorted(arc, arc + halfWidth, side='right') - 1
+                chord = xy[end] - xy[start]
+                length = arc[end] - arc[start]
+                straightness = np.hypot(*chord.T) / np.where(
+                    length > 0, length, np.inf)
+
+                placed = []
+                for i in np.argsort(-straightness, kind='stable'):
+                    if straightness[i] < 0.95:
+                        break
+                    box = (xy[i, 0] - halfWidth, xy[i, 1] - height / 2,
+                           xy[i, 0] + halfWidth, xy[i, 1] + height / 2)
+                    if (arc[i] < halfWidth or arc[i] > arc[-1] - halfWidth or
+                            not ax.bbox.contains(box[0], box[1]) or
+                            not ax.bbox.contains(box[2], box[3]) or
+                            any(abs(arc[i] - other) < spacing
+                                for other in placed) or
+                            any(box[0] < other[2] and other[0] < box[2] and
+                                box[1] < other[3] and other[1] < box[3]
+                                for other in occupied)):
+                        continue
+                    placed.append(arc[i])
+                    occupied.append(box)
+
+                    # Keep the text upright
+                    angle = np.rad2deg(np.arctan2(chord[i, 1], chord[i, 0]))
+                    angle = (angle + 90) % 180 - 90
+                    x, y = toData.transform(xy[i])
+                    labels.append(
+                        ax.text(x,
+                                y,
+                                text,
+                                fontsize=fontsize,
+                                rotation=angle,
+                                rotation_mode='anchor',
+                                horizontalalignment='center',
+                                verticalalignment='center',
+                                **kwargs))
+
+    return labels
+
+
 ###############################################################################
 # Plot:
 
@@ -96,39 +222,30 @@ contour3 = ax1.contour(tempisobar,
                        linestyles='solid',
                        zorder=4)
 
-# Create lists of coordinates where the contour labels are going to go
-# Before creating an axes over top of the contour plot, hover your
-# mouse over the locations where you want to plot the contour labels.
-# The coordinate will show up on the bottom right of the figure window.
-cont2Labels = [(1.71, 3.82), (5.49, 3.23), (9.53, 4.34), (9.27, 3.53),
-               (14.08, 4.81), (19.21, 2.24), (17.74, 1.00), (22.23, 3.87),
-               (12.87, 2.54), (10.45, 6.02), (11.51, 4.92)]
-
-cont3Labels = [(7.5, 6.1), (10.0, 4.58), (19.06, 1.91), (8.68, 0.46),
-               (19.52, 4.80), (16.7, 6.07), (8.62, 5.41), (18.53, 5.46)]
-
-# Manually plot contour labels
-cont2labels = ax1.clabel(contour2,
-                         manual=cont2Labels,
-                         fmt='%d',
-                         inline=True,
-                         fontsize=7)
-cont3labels = ax1.clabel(contour3,
-                         manual=cont3Labels,
-                         fmt='%d',
-                         inline=True,
-                         fontsize=7,
-                         colors='black')
-
-# Set contour label backgrounds white
-[
-    txt.set_bbox(dict(facecolor='white', edgecolor='none', pad=.5))
-    for txt in contour2.labelTexts
-]
-[
-    txt.set_bbox(dict(facecolor='white', edgecolor='none', pad=.5))
-    for txt in contour3.labelTexts
-]
+# Plot contour labels that do not overlap, first for the rh contours and then
+# for the tempisobar contours around them, with white backgrounds hiding the
+# contour lines under the labels
+occupied = []
+cont2labels = add_contour_labels(ax1,
+                                 contour2,
+                                 fontsize=7,
+                                 fmt='%d',
+                                 occupied=occupied,
+                                 color='black',
+                                 bbox=dict(facecolor='white',
+                                           edgecolor='none',
+                                           pad=.5),
+                                 zorder=5)
+cont3labels = add_contour_labels(ax1,
+                                 contour3,
+                                 fontsize=7,
+                                 fmt='%d',
+                                 occupied=occupied,
+                                 color='black',
+                                 bbox=dict(facecolor='white',
+                                           edgecolor='none',
+                                           pad=.5),
+                                 zorder=5)
 
 # Determine the labels for each tick on the x and y axes
 yticklabels = np.array(levels, dtype=np.int)
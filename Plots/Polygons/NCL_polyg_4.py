@@ -10,6 +10,7 @@ This script illustrates the following concepts:
    - Changing the color and thickness of polylines
    - Changing the color of a filled polygon
    - Labeling the lines in a polyline
+   - Placing contour labels automatically without overlaps
    - Changing the density of a fill pattern
    - Adding text to a plot
 
@@ -26,6 +27,9 @@ import xarray as xr
 import cartopy
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
+import matplotlib.path as mpath
+from matplotlib.collections import Collection
+from matplotlib.font_manager import FontProperties
 
 import geocat.datafiles as gdf
 from geocat.viz import util as gvutil
@@ -37,6 +41,129 @@ from geocat.viz import util as gvutil
 # Open a netCDF data file using xarray default engine and load the data into xarrays, choosing the 2nd timestamp
 ds = xr.open_dataset(gdf.get("netcdf_files/uv300.nc")).isel(time=1)
 
+###############################################################################
+# Utility Function: Add Contour Labels:
+# -------------------------------------
+
+
+def add_contour_labels(ax,
+                       contours,
+                       levels=None,
+                       fontsize=10,
+                       fmt='%d',
+                       spacing=150,
+                       occupied=None,
+                       **kwargs):
+    """
+    Utility function to label contours without overlaps. Every label is drawn directly as a text rotated along its
+    contour line, at the vertex where the line is straightest over the width of the label, provided that the label
+    is further than 'spacing' pixels along the line from the other labels of that line and does not overlap any
+    label box in 'occupied'.
+
+    Args:
+        ax (:class:`matplotlib.axes.Axes`):
+            Axis containing the contour set.
+        contours (:class:`matplotlib.contour.QuadContourSet`):
+            Contour set that is being labeled.
+        levels (:class:`list`):
+            Contour levels to label; all levels by default.
+        fontsize (:class:`int` or :class:`str`):
+            Font size of the contour labels.
+        fmt (:class:`str`):
+            Format of the contour labels.
+        spacing (:class:`float`):
+            Smallest distance in pixels between two labels of the same contour line.
+        occupied (:class:`list`):
+            Pixel boxes (x0, y0, x1, y1) of the labels already placed, extended in place.
+        **kwargs:
+            Other keyword arguments of the label texts (color, bbox, zorder...).
+    Returns:
+        labels (:class:`list`):
+            List of text instances of all contour labels
+    """
+
+    if occupied is None:
+        occupied = []
+
+    # Work in pixels, with the final axes position
+    ax.apply_aspect()
+    height = FontProperties(size=fontsize).get_size_in_points()
+    height *= ax.figure.dpi / 72
+    toPixels = contours.get_transform()
+    toData = ax.transData.inverted()
+
+    # Paths of every level: a collection per level before matplotlib 3.8, a single path per level since then
+    if isinstance(contours, Collection):
+        levelPaths = [[path] for path in contours.get_paths()]
+    else:
+        levelPaths = [
+            collection.get_paths() for collection in contours.collections
+        ]
+
+    labels = []
+    for level, paths in zip(contours.levels, levelPaths):
+        if levels is not None and level not in levels:
+            continue
+        text = fmt % level
+        halfWidth = 0.3 * height * len(text)
+        for path in paths:
+            vertices, codes = path.vertices, path.codes
+            if codes is not None:
+                keep = codes != mpath.Path.CLOSEPOLY
+                vertices, codes = vertices[keep], codes[keep]
+            splits = ([] if codes is None else
+                      np.flatnonzero(codes == mpath.Path.MOVETO)[1:])
+            for line in np.split(vertices, splits):
+                if len(line) < 2:
+                    continue
+                xy = toPixels.transform(line)
+                arc = np.concatenate(
+                    ([0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))
+
+                # Straightness of the line over the width of a label centered on every vertex
+                start = np.searchsorted(arc, arc - halfWidth)
+                end = np.searchsorted(arc, arc + halfWidth, side='right') - 1
+                chord = xy[end] - xy[start]
+                length = arc[end] - arc[start]
+                straightness = np.hypot(*chord.T) / np.where(
+                    length > 0, length, np.inf)
+
+                placed = []
+                for i in np.argsort(-straightness, kind='stable'):
+                    if straightness[i] < 0.95:
+                        break
+                    box = (xy[i, 0] - halfWidth, xy[i, 1] - height / 2,
+                           xy[i, 0] + halfWidth, xy[i, 1] + height / 2)
+                    if (arc[i] < halfWidth or arc[i] > arc[-1] - halfWidth or
+                            not ax.bbox.contains(box[0], box[1]) or
+                            not ax.bbox.contains(box[2], box[3]) or
+                            any(abs(arc[i] - other) < spacing
+                                for other in placed) or
+                            any(box[0] < other[2] and other[0] < box[2] and
+                                box[1] < other[3] and other[1] < box[3]
+                                for other in occupied)):
+                        continue
+                    placed.append(arc[i])
+                    occupied.append(box)
+
+                    # Keep the text upright
+                    angle = np.rad2deg(np.arctan2(chord[i, 1], chord[i, 0]))
+                    angle = (angle + 90) % 180 - 90
+                    x, y = toData.transform(xy[i])
+                    labels.append(
+                        ax.text(x,
+                                y,
+                                text,
+                                fontsize=fontsize,
+                                rotation=angle,
+                                rotation_mode='anchor',
+                                horizontalalignment='center',
+                                verticalalignment='center',
+                                **kwargs))
+
+    return labels
+
+
 ###############################################################################
 # Utility Function: Make Base Plot:
 # ---------------------------------
@@ -81,32 +208,15 @@ def make_base_plot():
     # Contourf-plot data (for filled contours)
     hdl = ds.U.plot.contour(x="lon", y="lat", ax=ax, **kwargs)
 
-    # Add contour labels.   Default contour labels are sparsely placed, so we specify label locations manually.
-    # Label locations only need to be approximate; the nearest contour will be selected.
-    label_locations = [
-        (-123, 35),
-        (-116, 17),
-        (-94, 4),
-        (-85, -6),
-        (-95, -10),
-        (-85, -15),
-        (-70, 35),
-        (-42, 28),
-        (-54, 7),
-        (-53, -5),
-        (-39, -11),
-        (-28, 11),
-        (-16, -1),
-        (-8, -9),  # Python allows trailing list separators.
-    ]
-    ax.clabel(
+    # Add contour labels.   Default contour labels are sparsely placed, so we place labels that are evenly spread
+    # along the contours without overlapping each other, without removing the contour line under the labels.
+    add_contour_labels(
+        ax,
         hdl,
-        np.arange(-8, 24, 8),  # Only label these contour levels: [-8, 0, 8, 16]
+        levels=np.arange(-8, 24, 8),  # Only label these contour levels: [-8, 0, 8, 16]
         fontsize="small",
-        colors="black",
         fmt="%.0f",  # Turn off decimal points
-        manual=label_locations,  # Manual label locations
-        inline=False)  # Don't remove the contour line where labels are located.
+        color="black")
 
     # Create a rectangle patch, to color the border of the rectangle a different color.
     # Specify the rectangle as a corner point with width and height, to help place border text more easily.
@@ -7,6 +7,7 @@ This script illustrates the following concepts:
    - Using shapefile data to plot unemployment percentages in the U.S.
    - Drawing a custom colorbar on a map
    - Drawing filled polygons over a Lambert Conformal plot
+   - Drawing all shapefile polygons as a single collection
    - Drawing the US with a Lambert Conformal projection
    - Zooming in on a particular area on a Lambert Conformal map
    - Centering the labels under the colorbar boxes
@@ -27,9 +28,10 @@ Note:
 ###############################################################################
 # Import packages:
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
+import matplotlib.collections as mcollections
 import matplotlib.colors as colors
 import matplotlib.cm as cm
+import matplotlib.path as mpath
 import matplotlib.ticker as mticker
 import shapefile as shp
 import numpy as np
@@ -77,6 +79,55 @@ def color_assignment(record):
         return colormap.colors[3]
 
 
+###############################################################################
+# Helper function to draw all shapes as one collection:
+
+
+def shapes_to_collection(shapes, facecolors, projection, **kwargs):
+    """
+    Utility function to create a single PathCollection drawing the polygons of all the shapes, rather than one
+    Polygon patch per part.  The points of all the shapes are read into one flat array, with the offsets of the parts,
+    and projected from longitude/latitude with a single transform_points call, so that the collection is drawn in
+    the projected coordinates of the axes without any further transformation.
+
+    Args:
+        shapes (:class:`list`):
+            Shapes read with pyshp, with longitude/latitude points.
+        facecolors (:class:`list`):
+            Face color of every shape.
+        projection (:class:`cartopy.crs.Projection`):
+            Projection of the axes the collection is added to.
+        kwargs:
+            Other properties of the collection (edgecolor, linewidth, zorder, ...).
+    Returns:
+        collection (:class:`matplotlib.collections.PathCollection`):
+            Collection with one path per part of every shape.
+    """
+
+    # Flat array of all the points, and start offsets of all the parts
+    points = np.concatenate([
+        np.asarray(shape.points, dtype=float).reshape(-1, 2) for shape in shapes
+    ])
+    shape_starts = np.cumsum([0] + [len(shape.points) for shape in shapes[:-1]])
+    part_starts = np.concatenate([
+        start + np.asarray(shape.parts, dtype=int)
+        for start, shape in zip(shape_starts, shapes)
+    ])
+    part_ends = np.append(part_starts[1:], len(points))
+    part_shapes = np.repeat(np.arange(len(shapes)),
+                            [len(shape.parts) for shape in shapes])
+
+    # Project all the points at once
+    xy = projection.transform_points(ccrs.PlateCarree(), points[:, 0],
+                                     points[:, 1])[:, :2]
+
+    paths = [
+        mpath.Path(xy[start:end]) for start, end in zip(part_starts, part_ends)
+    ]
+    return mcollections.PathCollection(
+        paths, facecolors=[facecolors[i] for i in part_shapes], **kwargs)
+
+
 ###############################################################################
 # Plot:
 plt.figure(figsize=(10, 8))
@@ -87,39 +138,20 @@ ax.set_extent([-125, -74, 22, 50])
 ax.add_feature(cfeature.LAND, color='silver', zorder=0)
 ax.add_feature(cfeature.LAKES, color='white', zorder=1)
 
-for i in range(0, len(shapefile.shapes())):
-    shape = shapefile.shape(i)
-    record = shapefile.record(i)
-    color = color_assignment(record)
-    # if a shape has multiple parts make each one a separate patch
-    if len(shape.parts) > 1:
-        for j in range(0, len(shape.parts)):
-            start_index = shape.parts[j]
-            # the last part uses the remaining points and doesn't require and end_index
-            if (j is (len(shape.parts) - 1)):
-                patch = mpatches.Polygon(shape.points[start_index:],
-                                         facecolor=color,
-                                         edgecolor='black',
-                                         linewidth=0.5,
-                                         transform=ccrs.PlateCarree(),
-                                         zorder=2)
-            else:
-                end_index = shape.parts[j + 1]
-                patch = mpatches.Polygon(shape.points[start_index:end_index],
-                                         facecolor=color,
-                                         edgecolor='black',
-                                         linewidth=0.5,
-                                         transform=ccrs.PlateCarree(),
-                                         zorder=2)
-            ax.add_patch(patch)
-    else:
-        patch = mpatches.Polygon(shape.points,
-                                 facecolor=color,
-                                 edgecolor='black',
-                                 linewidth=0.5,
-                                 transform=ccrs.PlateCarree(),
-                                 zorder=2)
-        ax.add_patch(patch)
+# Draw the states, colored by unemployment, as a single collection. States
+# without a color get the default patch color, as a patch would.
+color_list = [
+    color_assignment(record) or plt.rcParams['patch.facecolor']
+    for record in shapefile.records()
+]
+states = shapes_to_collection(shapefile.shapes(),
+                              color_list,
+                              ax.projection,
+                              edgecolor='black',
+                              linewidth=0.5,
+                              transform=ax.transData,
+                              zorder=2)
+ax.add_collection(states, autolim=False)
 
 # Create colorbar
 plt.colorbar(cm.ScalarMappable(cmap=colormap, norm=norm),
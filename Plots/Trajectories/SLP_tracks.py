@@ -0,0 +1,337 @@
+"""
+SLP_tracks.py
+===============
+This script illustrates the following concepts:
+   - Finding the local lows and highs of every time step of a field in one batched call
+   - Linking extrema into tracks with a nearest-neighbor search on the sphere
+   - Plotting trajectories on an orthographic projection
+
+The satellite map examples (NCL_sat_1.py, NCL_sat_2.py) find the highs and
+lows of one hand-picked day of ``slp.1963.nc``.  Here the lows and the highs
+of all days of 1963 are found at once, by filtering the whole (time, lat, lon)
+array, and the extrema of consecutive days are linked into cyclone and
+anticyclone tracks.  Distances between extrema are measured on the sphere, so
+tracks crossing the dateline or passing near the pole are handled correctly.
+"""
+
+###############################################################################
+# Import packages:
+import xarray as xr
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+import warnings
+
+import geocat.datafiles as gdf
+import geocat.viz.util as gvutil
+
+###############################################################################
+# Read in data:
+
+# Open a netCDF data file using xarray default engine and
+# load the data into xarrays
+ds = xr.open_dataset(gdf.get("netcdf_files/slp.1963.nc"), decode_times=False)
+
+# Convert Pa to hPa data
+pressure = ds.slp.astype('float64') * 0.01
+
+###############################################################################
+# Define a helper function to find the local extrema of every time step
+
+
+def findLocalExtrema(da, highVal=0, lowVal=1000, eType='Low', radius=10):
+    """
+    Utility function to find local low/high field variable coordinates on a contour map. To classify as a local high, the data
+    point must be greater than highVal, and to classify as a local low, the data point must be less than lowVal.
+
+    Candidates are the points lower (higher) than their eight neighbors, found for the whole grid at once with a minimum
+    (maximum) filter. Candidates closer than 'radius' degrees along a great circle are clustered together, using a KD-tree
+    of their positions on the unit sphere, and the lowest (highest) candidate of each cluster is kept. Distances are thus
+    correct near the poles and across the dateline, and the duplicated longitude of cyclic data (0 and 360 degrees) falls
+    in the same cluster.
+
+    Fields with leading dimensions (e.g. time, lat, lon) are searched in the same call, every field of the leading
+    dimensions (e.g. every time step) independently of the others.
+
+    Args:
+        da: (:class:`xarray.DataArray`):
+            Xarray data array containing the lat, lon, and field variable (ex. pressure) data values, with lat and lon
+            as its last two dimensions
+        highVal (:class:`int`):
+            Data value that the local high must be greater than to qualify as a "local high" location.
+            Default highVal is 0.
+        lowVal (:class:`int`):
+            Data value that the local low must be less than to qualify as a "local low" location.
+            Default lowVal is 1000.
+        eType (:class:`str`):
+            'Low' or 'High'
+            Determines which extrema are being found- minimum or maximum, respectively.
+            Default eType is 'Low'.
+        radius (:class:`float`):
+            Great circle distance in degrees within which only one local extremum is kept.
+            Default radius is 10.
+    Returns:
+        extremas (:class:`list`):
+            List of tuples (indices along the leading dimensions, if any, lon in degrees, lat in degrees, data value)
+            that specify local low/high locations and values, in the order of the leading indices
+    """
+
+    lons = np.asarray(da.lon)
+    lats = np.asarray(da.lat)
+    data = np.asarray(da.data, dtype='float64')
+
+    # Search maxima of the negated field for lows, so that both types of extrema share the code below.
+    # Missing values can never be extrema.
+    if eType == 'Low':
+        field = np.where(np.isnan(data), -np.inf, -data)
+        threshold = -lowVal
+    if eType == 'High':
+        field = np.where(np.isnan(data), -np.inf, data)
+        threshold = highVal
+
+    # Global grids wrap around in longitude
+    cyclic = np.isclose(abs(lons[1] - lons[0]) * lons.size, 360)
+
+    # Find the points holding the largest value of their 3x3 neighborhood, in every field of the leading dimensions
+    leading = data.ndim - 2
+    neighborhoodMax = ndimage.maximum_filter(
+        field,
+        size=(1,) * leading + (3, 3),
+        mode=('nearest',) * (leading + 1) + ('wrap' if cyclic else 'nearest',))
+    *indices, y, x = np.nonzero((field == neighborhoodMax) & (field > threshold))
+
+    if y.size == 0:
+        if eType == 'Low':
+            warnings.warn(
+                'No local extrema with data value less than given lowVal')
+        if eType == 'High':
+            warnings.warn(
+                'No local extrema with data value greater than given highVal')
+        return []
+
+    # Cluster the candidates closer than 'radius' on the unit sphere; the chord between two unit vectors is
+    # 2 * sin(angle / 2), at most 2, so a coordinate spaced by 10 between the fields of the leading dimensions never
+    # lets two fields share a cluster
+    fieldIndex = np.ravel_multi_index(indices,
+                                      data.shape[:leading]) if leading else 0
+    lonRad, latRad = np.deg2rad(lons[x]), np.deg2rad(lats[y])
+    xyz = np.column_stack((np.cos(latRad) * np.cos(lonRad),
+                           np.cos(latRad) * np.sin(lonRad), np.sin(latRad),
+                           np.broadcast_to(10.0 * fieldIndex, y.shape)))
+    pairs = cKDTree(xyz).query_pairs(2 * np.sin(np.deg2rad(radius) / 2),
+                                     output_type='ndarray').reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(y.size, y.size))
+    _, clusters = connected_components(graph, directed=False)
+
+    # Keep the largest value of every cluster, in the order of the leading indices
+    values = data[tuple(indices) + (y, x)]
+    order = np.argsort(values if eType == 'Low' else -values, kind='stable')
+    _, first = np.unique(clusters[order], return_index=True)
+    best = np.sort(order[first])
+
+    return [
+        tuple(int(index[i]) for index in indices) +
+        (float(lons[x[i]]), float(lats[y[i]]), float(values[i])) for i in best
+    ]
+
+
+###############################################################################
+# Define helper functions to link the extrema into tracks
+
+
+def lonLatToXYZ(lons, lats):
+    """Return the unit vectors of points given in degrees."""
+    lons, lats = np.deg2rad(lons), np.deg2rad(lats)
+    return np.column_stack((np.cos(lats) * np.cos(lons),
+                            np.cos(lats) * np.sin(lons), np.sin(lats)))
+
+
+def linkTracks(times, lons, lats, maxDistance=1200):
+    """
+    Utility function to link extrema of consecutive time steps into tracks. Every extremum continues the track of the
+    nearest extremum of the previous time step closer than maxDistance, found with a KD-tree of unit vectors so that
+    distances are correct across the dateline and near the poles. When several extrema are closest to the same
+    previous one, the closest continues its track and the others start new tracks.
+
+    Args:
+        times, lons, lats (:class:`numpy.ndarray`):
+            Time indices (sorted) and locations in degrees of the extrema, as returned by findLocalExtrema.
+        maxDistance (:class:`float`):
+            Distance in km an extremum can travel between two time steps.
+    Returns:
+        trackIds (:class:`numpy.ndarray`):
+            Track number of every extremum
+    """
+
+    # Chord length between unit vectors equivalent to maxDistance along the great circle
+    earthRadius = 6371.0
+    maxChord = 2 * np.sin(maxDistance / earthRadius / 2)
+
+    xyz = lonLatToXYZ(lons, lats)
+    trackIds = np.full(times.size, -1)
+
+    steps = np.unique(times)
+    starts = np.searchsorted(times, steps)
+    ends = np.append(starts[1:], times.size)
+    nextId = 0
+    previous = np.array([], dtype=int)
+    previousStep = None
+    for step, start, end in zip(steps, starts, ends):
+        current = np.arange(start, end)
+
+        matched = np.zeros(current.size, dtype=bool)
+        if previous.size and step == previousStep + 1:
+            distance, nearest = cKDTree(xyz[previous]).query(
+                xyz[current], distance_upper_bound=maxChord)
+            found = np.isfinite(distance)
+
+            # Closest claims first: keep the first occurrence of every previous extremum, in order of distance
+            order = np.argsort(distance)
+            order = order[found[order]]
+            _, first = np.unique(nearest[order], return_index=True)
+            winners = order[first]
+            trackIds[current[winners]] = trackIds[previous[nearest[winners]]]
+            matched[winners] = True
+
+        # Extrema not continuing a track start a new one
+        newTracks = current[~matched]
+        trackIds[newTracks] = np.arange(nextId, nextId + newTracks.size)
+        nextId += newTracks.size
+
+        previous, previousStep = current, step
+
+    return trackIds
+
+
+###############################################################################
+# Find and link the lows and the highs of all time steps:
+
+
+def longTracks(times, lons, lats, minLength=4):
+    """
+    Utility function to link extrema into tracks and keep the tracks lasting at least minLength time steps.
+
+    Returns:
+        trackIds, tracks (:class:`numpy.ndarray`):
+            Track number of every extremum, and the numbers of the tracks that are kept
+    """
+    trackIds = linkTracks(times, lons, lats)
+    trackNumbers, trackLengths = np.unique(trackIds, return_counts=True)
+    return trackIds, trackNumbers[trackLengths >= minLength]
+
+
+def extremaArrays(extrema, minLat=20):
+    """
+    Utility function returning the time indices, longitudes, latitudes and values of the extrema of a (time, lat, lon)
+    field, as returned by findLocalExtrema, as separate arrays. Only the extrema north of minLat are kept; the field is
+    searched globally first so that no false extrema appear along the minLat edge.
+    """
+    times, lons, lats, values = np.array(extrema, dtype='float64').reshape(-1, 4).T
+    keep = lats >= minLat
+    return times[keep].astype(int), lons[keep], lats[keep], values[keep]
+
+
+lowTimes, lowLons, lowLats, lowValues = extremaArrays(
+    findLocalExtrema(pressure, lowVal=1000, eType='Low'))
+lowIds, lowTracks = longTracks(lowTimes, lowLons, lowLats)
+
+highTimes, highLons, highLats, highValues = extremaArrays(
+    findLocalExtrema(pressure, highVal=1030, eType='High'))
+highIds, highTracks = longTracks(highTimes, highLons, highLats)
+
+###############################################################################
+# Define a helper function to plot tracks
+
+
+def plotTracks(lons, lats, values, trackIds, tracks, cmap, norm, reduce,
+               label):
+    """
+    Utility function drawing tracks on an orthographic map of the Northern Hemisphere, every track colored by
+    reduce() of its values, with a dot where it starts.
+    """
+
+    # Set figure size
+    plt.figure(figsize=(8, 8))
+
+    # Set global axes with an orthographic projection
+    proj = ccrs.Orthographic(central_longitude=270, central_latitude=60)
+    ax = plt.axes(projection=proj)
+    ax.set_global()
+
+    # Add land, coastlines, and ocean features
+    ax.add_feature(cfeature.LAND, facecolor='lightgray')
+    ax.add_feature(cfeature.COASTLINE, linewidth=.5)
+    ax.add_feature(cfeature.OCEAN, facecolor='lightcyan')
+
+    for track in tracks:
+        members = trackIds == track
+        color = cmap(norm(reduce(values[members])))
+        ax.plot(lons[members],
+                lats[members],
+                color=color,
+                linewidth=1,
+                transform=ccrs.Geodetic())
+        ax.plot(lons[members][0],
+                lats[members][0],
+                'o',
+                color=color,
+                markersize=3,
+                transform=ccrs.Geodetic())
+
+    # Add a colorbar of the extreme pressure of the tracks
+    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
+    cbar = plt.colorbar(sm,
+                        ax=ax,
+                        orientation='horizontal',
+                        shrink=0.7,
+                        pad=0.05)
+    cbar.set_label(label)
+
+    return ax
+
+
+###############################################################################
+# Plot: Cyclone tracks
+
+ax = plotTracks(lowLons, lowLats, lowValues, lowIds, lowTracks,
+                plt.get_cmap('viridis'), plt.Normalize(950, 1000), np.min,
+                'Lowest pressure along the track (hPa)')
+
+# Use gvutil function to set title and subtitles
+gvutil.set_titles_and_labels(
+    ax,
+    maintitle=r"$\bf{Cyclone}$" + " " + r"$\bf{tracks,}$" + " " +
+    r"$\bf{1963}$",
+    maintitlefontsize=20,
+    lefttitle=f"{lowTracks.size} tracks of lows below 1000 hPa",
+    lefttitlefontsize=14,
+    righttitle="4+ days",
+    righttitlefontsize=14)
+
+plt.show()
+
+###############################################################################
+# Plot: Anticyclone tracks
+
+ax = plotTracks(highLons, highLats, highValues, highIds, highTracks,
+                plt.get_cmap('magma_r'), plt.Normalize(1030, 1060), np.max,
+                'Highest pressure along the track (hPa)')
+
+# Use gvutil function to set title and subtitles
+gvutil.set_titles_and_labels(
+    ax,
+    maintitle=r"$\bf{Anticyclone}$" + " " + r"$\bf{tracks,}$" + " " +
+    r"$\bf{1963}$",
+    maintitlefontsize=20,
+    lefttitle=f"{highTracks.size} tracks of highs above 1030 hPa",
+    lefttitlefontsize=14,
+    righttitle="4+ days",
+    righttitlefontsize=14)
+
+plt.show()
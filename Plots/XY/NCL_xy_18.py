@@ -6,6 +6,7 @@ This script illustrates the following concepts:
     - Labeling the bottom X axis with years
     - Drawing a main title on three separate lines
     - Calculating a weighted average
+    - Calculating ensemble statistics in a single pass over the members
     - Changing the size/shape of an XY plot using viewport resources
     - Manually creating a legend
     - Overlaying XY plots on each other
@@ -19,6 +20,11 @@ See following URLs to see the reproduced NCL plot & script:
 ###############################################################################
 # Import packages:
 # ----------------
+import hashlib
+import json
+import os
+import tempfile
+
 import numpy as np
 import xarray as xr
 from matplotlib import pyplot as plt
@@ -72,6 +78,25 @@ from geocat.viz import util as gvutil
 # coordinate variable to ``noleap``, and returns the *decoded* dataset (using
 # the Xarray function ``decode_cf``).  Work-arounds like this are needed
 # whenever you have "errors" or "inconsistancies" in your data.
+#
+# We wrap ``open_mfdataset`` in an ensemble loader (``open_ensemble``) that
+# suits ensembles of many members:
+#
+# - The ``parallel=True`` argument opens and pre-processes the member files
+#   concurrently, with Dask, instead of one after the other.
+# - The ``chunks`` argument is chosen for the reduction we compute below, a
+#   mean over latitude and longitude: every chunk holds whole horizontal
+#   fields of one member, and as many time steps as fit in ``chunk_bytes``.
+# - The first time an ensemble is opened, ``open_mfdataset`` checks that the
+#   coordinates of all members agree.  The loader then saves an index of the
+#   members (their paths, sizes and modification times) and of the chosen
+#   chunks in the temporary directory, so that the data directory, which may
+#   be a shared read-only copy, is left untouched.  Later opens of the same,
+#   unchanged, members read the chunks from the index, and skip the
+#   pre-processing of every file and the comparison of their coordinates,
+#   which the index records as already checked: the coordinates of the first
+#   member are used, and the calendar fix is applied once to the combined
+#   dataset.
 
 
 # Define the xarray.open_mfdataset pre-processing function
@@ -81,6 +106,57 @@ def assume_noleap_calendar(ds):
     return xr.decode_cf(ds)
 
 
+# Define the ensemble loader
+def open_ensemble(files, chunk_bytes=32 * 2**20):
+    members = [[f, os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+    digest = hashlib.sha1('\n'.join(files).encode()).hexdigest()[:16]
+    index_path = os.path.join(tempfile.gettempdir(),
+                              f'ensemble-{digest}.json')
+
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    if index is not None and index['members'] == members:
+        ds = xr.open_mfdataset(files,
+                               concat_dim='case',
+                               combine='nested',
+                               decode_times=False,
+                               parallel=True,
+                               chunks=index['chunks'],
+                               coords='minimal',
+                               compat='override',
+                               join='override')
+        return assume_noleap_calendar(ds)
+
+    # Fit as many horizontal fields as possible in a chunk
+    with xr.open_dataset(files[0], decode_times=False) as first:
+        field_bytes = max(
+            first.sizes['lat'] * first.sizes['lon'] * var.dtype.itemsize
+            for var in first.data_vars.values()
+            if 'lat' in var.dims and 'lon' in var.dims)
+    chunks = {'time': max(1, chunk_bytes // field_bytes)}
+
+    ds = xr.open_mfdataset(files,
+                           concat_dim='case',
+                           combine='nested',
+                           preprocess=assume_noleap_calendar,
+                           decode_times=False,
+                           parallel=True,
+                           chunks=chunks)
+
+    # Write the index in the temporary directory, replacing any previous one
+    # at once; the index is only an optimization, so it is skipped if it
+    # cannot be written
+    try:
+        with open(index_path + '.partial', 'w') as f:
+            json.dump({'members': members, 'chunks': chunks}, f)
+        os.replace(index_path + '.partial', index_path)
+    except OSError:
+        pass
+    return ds
+
+
 # Create a dataset for the "natural" (i.e., no anthropogenic effects) data
 nfiles = [
     gdf.get("netcdf_files/TREFHT.B06.66.atm.1890-1999ANN.nc"),
@@ -88,11 +164,7 @@ nfiles = [
     gdf.get("netcdf_files/TREFHT.B06.68.atm.1890-1999ANN.nc"),
     gdf.get("netcdf_files/TREFHT.B06.69.atm.1890-1999ANN.nc")
 ]
-nds = xr.open_mfdataset(nfiles,
-                        concat_dim='case',
-                        combine='nested',
-                        preprocess=assume_noleap_calendar,
-                        decode_times=False)
+nds = open_ensemble(nfiles)
 
 # Create a dataset for the "natural + anthropogenic" data
 vfiles = [
@@ -101,18 +173,23 @@ vfiles = [
     gdf.get("netcdf_files/TREFHT.B06.60.atm.1890-1999ANN.nc"),
     gdf.get("netcdf_files/TREFHT.B06.57.atm.1890-1999ANN.nc")
 ]
-vds = xr.open_mfdataset(vfiles,
-                        concat_dim='case',
-                        combine='nested',
-                        preprocess=assume_noleap_calendar,
-                        decode_times=False)
-
-# Read the "weights" file
-# (The xarray.Dataset.expand_dims call adds the longitude dimension to the
-# dataset, which originally depends only upon the latitude dimension. This
-# arguably makes computing the weighted means below more straight-forward.)
-gds = xr.open_dataset(gdf.get("netcdf_files/gw.nc"))
-gds = gds.expand_dims(dim={'lon': nds.lon})
+vds = open_ensemble(vfiles)
+
+# Number of time steps in a chunk, read at a time when computing the weighted
+# means below
+time_chunk = nds.chunks['time'][0]
+
+###############################################################################
+# Latitude Weights:
+# -----------------
+#
+# Read the "weights" file.  The Gaussian weights ``gw`` only depend upon
+# latitude, so we keep them as a 1-D array along the ``lat`` dimension rather
+# than expanding them along ``lon``: the weighted means below broadcast them
+# against the ``(case, time, lat, lon)`` data without building a full
+# ``(lat, lon)`` copy.
+
+gw = xr.open_dataset(gdf.get("netcdf_files/gw.nc"))['gw']
 
 ###############################################################################
 # Observations:
@@ -137,11 +214,85 @@ obs = xr.DataArray(name='TREFHT', data=obs_data, coords=[('time', obs_time)])
 # ---------------------------------
 #
 # We define this function just for convenience.  This is equivalent to how
-# NCL computes the weighted mean.
+# NCL computes the weighted mean, ``sum(var * wgts) / sum(wgts)`` over the
+# latitudes and longitudes, but it streams through the data instead of
+# building the full ``(case, time, lat, lon)`` product of the data and the
+# weights: each block of ``chunk_size`` time steps of one case is read,
+# averaged along the longitudes, and reduced with the 1-D latitude weights
+# directly into the output array.  The memory used is bounded by one block,
+# so the same function runs on ensembles of many members at high resolution.
+
+
+def horizontal_weighted_mean(var, wgts, chunk_size=time_chunk):
+    var = var.transpose('case', 'time', 'lat', 'lon')
+    weights = np.asarray(wgts.sel(lat=var['lat']), dtype=np.float64)
+    weights = weights / weights.sum()
+
+    result = np.empty((var.sizes['case'], var.sizes['time']))
+    for case in range(var.sizes['case']):
+        for start in range(0, var.sizes['time'], chunk_size):
+            block = var.isel(case=case,
+                             time=slice(start, start + chunk_size)).values
+            np.dot(block.mean(axis=-1, dtype=np.float64),
+                   weights,
+                   out=result[case, start:start + len(block)])
+
+    return xr.DataArray(result,
+                        coords={'time': var['time']},
+                        dims=['case', 'time'])
 
 
-def horizontal_weighted_mean(var, wgts):
-    return (var * wgts).sum(dim=['lat', 'lon']) / wgts.sum(dim=['lat', 'lon'])
+###############################################################################
+# Time Selection and Alignment Functions:
+# ---------------------------------------
+#
+# The model and observation time coordinates hold ``cftime`` dates, which are
+# Python objects: selecting dates by comparing them (e.g., with
+# ``.sel(time=slice('1890', '1920'))``) compares every date object with the
+# bounds, which gets slow for long and many series.  Instead, we convert each
+# time axis once into integer arrays (the year, the month and a month ordinal,
+# ``12 * year + month - 1``, which are valid in any calendar) and keep them in
+# a cache.  Selections and the matching of observations with model years are
+# then done with vectorized integer operations.
+
+# Integer arrays of the time axes converted so far, by id of the time index
+# (the index is kept with them, so that its id is not reused)
+_time_axes = {}
+
+
+def time_axis(da):
+    index = da.indexes['time']
+    key = id(index)
+    if key not in _time_axes:
+        years = np.asarray(index.year, dtype=np.int64)
+        months = np.asarray(index.month, dtype=np.int64)
+        _time_axes[key] = (index, {
+            'year': years,
+            'month': months,
+            'month_index': 12 * years + months - 1
+        })
+    return _time_axes[key][1]
+
+
+def select_time(da, years=None, months=None):
+    axis = time_axis(da)
+    keep = np.ones(da.sizes['time'], dtype=bool)
+    if years is not None:
+        keep &= (axis['year'] >= years[0]) & (axis['year'] <= years[1])
+    if months is not None:
+        keep &= np.isin(axis['month'], months)
+    return da.isel(time=keep)
+
+
+def align_years(obs, model):
+    # Pair the first time step of every year found in both series, and give
+    # the observations the model time coordinate
+    _, obs_steps, model_steps = np.intersect1d(time_axis(obs)['year'],
+                                               time_axis(model)['year'],
+                                               return_indices=True)
+    model = model.isel(time=model_steps)
+    obs = obs.isel(time=obs_steps).assign_coords(time=model['time'].values)
+    return obs, model
 
 
 ###############################################################################
@@ -152,8 +303,8 @@ def horizontal_weighted_mean(var, wgts):
 # (leaving only the ``case`` and ``time`` dimensions), and then we compute the
 # anomaly measured from the average of the first 30 years.
 
-gavn = horizontal_weighted_mean(nds["TREFHT"], gds["gw"])
-gavan = gavn - gavn.sel(time=slice('1890', '1920')).mean(dim='time')
+gavn = horizontal_weighted_mean(nds["TREFHT"], gw)
+gavan = gavn - select_time(gavn, years=(1890, 1920)).mean(dim='time')
 
 ###############################################################################
 # Natural + Anthropogenic data:
@@ -161,17 +312,131 @@ gavan = gavn - gavn.sel(time=slice('1890', '1920')).mean(dim='time')
 #
 # We do the same thing for the "natural + anthropogenic" data.
 
-gavv = horizontal_weighted_mean(vds["TREFHT"], gds["gw"])
-gavav = gavv - gavv.sel(time=slice('1890', '1920')).mean(dim='time')
+gavv = horizontal_weighted_mean(vds["TREFHT"], gw)
+gavav = gavv - select_time(gavv, years=(1890, 1920)).mean(dim='time')
 
 ###############################################################################
 # Observation data:
 # -----------------
 #
-# We do the same thing for the observation data.
+# We do the same thing for the observation data, and then we pair the
+# observations with the model years.
+
+obs_avg = obs - select_time(obs, years=(1890, 1920)).mean(dim='time')
+
+# Keep the observations of the model years, on the model time axis
+obs_avg, _ = align_years(obs_avg, gavn)
+
+###############################################################################
+# Streaming Ensemble Statistics Function:
+# ---------------------------------------
+#
+# We define a function computing the statistics across the ensemble members
+# of every time step in a single pass over the members, which are read one at
+# a time: the mean is updated incrementally, the extrema with running minima
+# and maxima, and the quantiles are estimated with the P-square algorithm
+# (Jain and Chlamtac, 1985), which tracks five markers per quantile instead of
+# keeping and sorting all the members.  The memory used does not depend on
+# the number of members, so the envelopes stay cheap to compute for large
+# ensembles.  P-square estimates are poor for small
+# samples, so up to ``exact_members`` members are kept and their quantiles are
+# computed exactly; past that count, the P-square markers start from the
+# exact quantiles of the members kept, which are then dropped.
+
+
+def ensemble_statistics(members,
+                        quantiles=(0.1, 0.5, 0.9),
+                        exact_members=50):
+    quantiles = np.asarray(quantiles, dtype=np.float64)[:, np.newaxis]
+    increments = np.hstack([
+        np.zeros_like(quantiles), quantiles / 2, quantiles, (1 + quantiles) / 2,
+        np.ones_like(quantiles)
+    ])[:, :, np.newaxis]
+
+    # Start the statistics from the first member
+    members = iter(members)
+    member = next(members, None)
+    if member is None:
+        raise ValueError('the ensemble has no members')
+    time = member['time']
+    mean = np.asarray(member, dtype=np.float64).copy()
+    low = mean.copy()
+    high = mean.copy()
+    first = [mean.copy()]
+    count = 1
+
+    for member in members:
+        x = np.asarray(member, dtype=np.float64)
+        count += 1
+
+        # Running update of the mean
+        mean += (x - mean) / count
+        np.minimum(low, x, out=low)
+        np.maximum(high, x, out=high)
+
+        if first is not None:
+            first.append(x)
+            if count <= exact_members:
+                continue
+
+            # Start the five P-square markers of every quantile and time step
+            # at the exact quantiles of the members so far, at their desired
+            # positions
+            heights = np.quantile(first, increments.ravel(), axis=0)
+            heights = heights.reshape(increments.shape[:2] + (x.size,))
+            positions = np.broadcast_to(1 + (count - 1) * increments,
+                                        heights.shape).copy()
+            desired = positions.copy()
+            first = None
+            continue
+
+        # Find the cell of the new value, extending the extreme markers
+        cell = np.sum(x >= heights[:, 1:4], axis=1)
+        np.minimum(heights[:, 0], x, out=heights[:, 0])
+        np.maximum(heights[:, 4], x, out=heights[:, 4])
+        positions += np.arange(5)[:, np.newaxis] > cell[:, np.newaxis]
+        desired = desired + increments
+
+        # Move the middle markers that are off their desired positions by one
+        # or more, with a parabolic prediction of their height, or a linear
+        # one when the parabolic prediction is not between the neighbors
+        for i in (1, 2, 3):
+            d = desired[:, i] - positions[:, i]
+            below = positions[:, i - 1] - positions[:, i]
+            above = positions[:, i + 1] - positions[:, i]
+            move = ((d >= 1) & (above > 1)) | ((d <= -1) & (below < -1))
+            d = np.sign(d) * move
+
+            q = heights[:, i]
+            qBelow = heights[:, i - 1]
+            qAbove = heights[:, i + 1]
+            parabolic = q + d / (above - below) * (
+                (d - below) * (qAbove - q) / above +
+                (above - d) * (q - qBelow) / -below)
+            linear = q + d * np.where(d > 0, (qAbove - q) / above,
+                                      (qBelow - q) / below)
+            heights[:, i] = np.where(
+                (qBelow < parabolic) & (parabolic < qAbove), parabolic, linear)
+            positions[:, i] += d
+
+    if first is not None:
+        estimates = np.quantile(first, quantiles[:, 0], axis=0)
+    else:
+        estimates = heights[:, 2]
+
+    return xr.Dataset(
+        {
+            'mean': ('time', mean),
+            'min': ('time', low),
+            'max': ('time', high),
+            'percentile': (['quantile', 'time'], estimates)
+        },
+        coords={
+            'time': time,
+            'quantile': quantiles[:, 0]
+        },
+        attrs={'members': count})
 
-obs_avg = obs.sel(time=slice('1890', '1999')) - obs.sel(
-    time=slice('1890', '1920')).mean(dim='time')
 
 ###############################################################################
 # Calculate the ensemble Min. & Max. & Mean:
@@ -179,15 +444,24 @@ obs_avg = obs.sel(time=slice('1890', '1999')) - obs.sel(
 #
 # Here we find the ``min``, ``max``, and ``mean`` along the ``case`` (i.e.,
 # ensemble) dimension (leaving only the ``time`` dimension) for both of our
-# datasets.  We compute the equivalent anomaly for the observations data.
-
-gavan_min = gavan.min(dim='case')
-gavan_max = gavan.max(dim='case')
-gavan_avg = gavan.mean(dim='case')
-
-gavav_min = gavav.min(dim='case')
-gavav_max = gavav.max(dim='case')
-gavav_avg = gavav.mean(dim='case')
+# datasets, passing the members one at a time to the streaming statistics
+# function.  The 10th and 90th percentiles across the members, computed along
+# the way, give the spread of the ensembles inside their envelopes.  We compute the equivalent
+# anomaly for the observations data.
+
+gavan_stats = ensemble_statistics(
+    gavan.isel(case=i) for i in range(gavan.sizes['case']))
+gavan_min = gavan_stats['min']
+gavan_max = gavan_stats['max']
+gavan_avg = gavan_stats['mean']
+gavan_p10, gavan_p90 = gavan_stats['percentile'].sel(quantile=[0.1, 0.9])
+
+gavav_stats = ensemble_statistics(
+    gavav.isel(case=i) for i in range(gavav.sizes['case']))
+gavav_min = gavav_stats['min']
+gavav_max = gavav_stats['max']
+gavav_avg = gavav_stats['mean']
+gavav_p10, gavav_p90 = gavav_stats['percentile'].sel(quantile=[0.1, 0.9])
 
 ###############################################################################
 # Plot:
@@ -241,6 +515,11 @@ ax.set_ylabel('$^\circ$C', fontsize=24)
 ax.fill_between(time, gavan_min, gavan_max, color='lightblue', zorder=0)
 ax.fill_between(time, gavav_min, gavav_max, color='lightpink', zorder=1)
 
+# Shade the spread between the 10th and 90th percentiles inside the envelopes
+ax.fill_between(time, gavan_p10, gavan_p90, color='lightskyblue', zorder=1)
+ax.fill_between(time, gavav_p10, gavav_p90, color='hotpink', alpha=0.5,
+                zorder=1)
+
 # Show the plot
 plt.tight_layout()
 plt.show()
@@ -12,9 +12,9 @@
 #
 import importlib
 import os
+import sys
 import warnings
-# import sys
-# sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(0, os.path.abspath('.'))
 
 # -- Project information -----------------------------------------------------
 
@@ -29,6 +29,9 @@ author = 'GeoCAT'
 # ones.
 extensions = [
     'sphinx_gallery.gen_gallery',
+    'tools.gallery_runner',
+    'tools.prefetch',
+    'tools.rechunk',
 ]
 
 # Add any paths that contain templates here, relative to this directory.
@@ -76,14 +79,61 @@ master_doc = 'index'
 
 # Configure sphinx-gallery plugin
 from sphinx_gallery.sorting import ExampleTitleSortKey
+from tools.render import BatchScraper, RenderScraper
+
+# Scraper of the gallery figures: 'matplotlib', the scraper of sphinx-gallery,
+# or 'render', which rasterizes every figure through a cache of the
+# backgrounds shared by several figures (see tools/render.py); e.g.
+# GALLERY_SCRAPER=render
+gallery_scraper = os.environ.get('GALLERY_SCRAPER', 'matplotlib')
+if gallery_scraper not in ('matplotlib', 'render'):
+    raise ValueError(f'unknown gallery scraper: {gallery_scraper}')
+render_cache_dir = (os.path.abspath(os.path.join('_build', 'render_cache'))
+                    if gallery_scraper == 'render' else None)
+
+# Batch render mode, writing all the outputs of every figure from a single
+# rendering; e.g. GALLERY_IMAGE_FORMATS=png,webp,pdf GALLERY_SMALL_DPI=30
+image_formats = [
+    fmt.strip()
+    for fmt in os.environ.get('GALLERY_IMAGE_FORMATS', '').split(',')
+    if fmt.strip()
+]
+small_dpi = int(os.environ.get('GALLERY_SMALL_DPI', 0))
+if image_formats or small_dpi:
+    image_scrapers = (BatchScraper(render_cache_dir,
+                                   formats=image_formats or ['png'],
+                                   small_dpi=small_dpi),)
+elif render_cache_dir is not None:
+    image_scrapers = (RenderScraper(render_cache_dir),)
+else:
+    image_scrapers = ('matplotlib',)
+
 sphinx_gallery_conf = {
     'examples_dirs': ['Plots',],  # path to your example scripts
     'filename_pattern': '^((?!sgskip).)*$',
     'gallery_dirs': ['gallery'
                     ],  # path to where to save gallery generated output
     'within_subsection_order': ExampleTitleSortKey,
+    'image_scrapers': image_scrapers,
 }
 
+# Number of processes used to execute the gallery examples (see
+# tools/gallery_runner.py); override with "-D gallery_jobs=N" or GALLERY_JOBS
+gallery_jobs = int(os.environ.get('GALLERY_JOBS', 1))
+
+# Cache of executed examples, keyed by script, input data and package versions
+# (see tools/gallery_cache.py); disabled by default, enable it with e.g.
+# GALLERY_CACHE_DIR=_build/gallery_cache
+gallery_cache_dir = os.environ.get('GALLERY_CACHE_DIR', '')
+
+# Local copy of the GeoCAT-datafiles repository used by the data prefetch step
+# (see tools/prefetch.py) instead of downloading, e.g. on offline machines
+gallery_data_mirror = os.environ.get('GEOCAT_DATA_MIRROR', '')
+
+# Chunked Zarr copies of the NetCDF data files, written by
+# "python -m tools.rechunk" and read instead of the NetCDF files when present
+gallery_zarr_store = os.path.join('_build', 'zarr_store')
+
 html_theme_options = {
     'navigation_depth': 2,
 }
@@ -94,4 +144,5 @@ import logging
 import pooch
 logger = pooch.get_logger()
 logger.setLevel(logging.WARNING)
-geocat.datafiles.get("registry.txt")
+if not gallery_data_mirror:
+    geocat.datafiles.get("registry.txt")
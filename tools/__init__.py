@@ -0,0 +1,7 @@
+"""
+Build tooling for the GeoCAT-examples gallery.
+
+The modules in this package are Sphinx extensions and command line utilities
+used while building the documentation; the example scripts in ``Plots/`` do
+not depend on them.
+"""
@@ -0,0 +1,394 @@
+"""
+Per-phase timing benchmark of the gallery examples.
+
+Every example is executed in a fresh Python process (with the Agg backend)
+and its wall-clock time is split into phases:
+
+    imports  - executing ``import`` statements
+    io       - fetching data files and reading them (``gdf.get``,
+               ``xr.open_dataset``, netCDF variable reads, ``np.loadtxt``, ...)
+    compute  - geocat.comp functions, xarray reductions, clustering and
+               filtering routines
+    render   - rasterizing the figures, which is done in ``plt.show`` the
+               same way sphinx-gallery's image scraper does
+    figure   - everything else, i.e. building the figures and artists
+
+Phases nest: time spent importing a module while reading a file counts as
+``imports``, not ``io``.
+
+Each benchmark run is appended to a JSON history file and compared against a
+stored baseline; examples whose phase times regress by more than the given
+threshold are reported and make the command exit with status 1.
+
+Usage, from the root directory of the repository::
+
+    python -m tools.benchmark                      # all Plots/**/NCL_*.py
+    python -m tools.benchmark Plots/XY/NCL_xy_18.py --repeat 3
+    python -m tools.benchmark --save-baseline      # store this run as baseline
+"""
+
+import argparse
+import builtins
+import collections
+import contextlib
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ('imports', 'io', 'compute', 'figure', 'render')
+
+# (module, attribute, phase) of the callables timed in the child process;
+# dotted attributes name methods of classes in that module
+INSTRUMENTED = [
+    ('geocat.datafiles', 'get', 'io'),
+    ('xarray', 'open_dataset', 'io'),
+    ('xarray', 'open_mfdataset', 'io'),
+    ('xarray', 'open_dataarray', 'io'),
+    ('xarray.backends.netCDF4_', 'NetCDF4ArrayWrapper.__getitem__', 'io'),
+    ('xarray.backends.scipy_', 'ScipyArrayWrapper.__getitem__', 'io'),
+    ('netCDF4', 'Dataset.__init__', 'io'),
+    ('numpy', 'loadtxt', 'io'),
+    ('pandas', 'read_csv', 'io'),
+    ('shapefile', 'Reader.__init__', 'io'),
+    ('xarray', 'DataArray.reduce', 'compute'),
+    ('xarray', 'Dataset.reduce', 'compute'),
+    ('scipy.ndimage', 'minimum_filter', 'compute'),
+    ('scipy.ndimage', 'maximum_filter', 'compute'),
+    ('scipy.ndimage', 'label', 'compute'),
+    ('matplotlib.figure', 'Figure.savefig', 'render'),
+    ('matplotlib.backends.backend_agg', 'FigureCanvasAgg.draw', 'render'),
+]
+
+# Every public function of these modules is timed as computation
+COMPUTE_MODULES = ('geocat.comp',)
+
+
+class PhaseTimer:
+    """Accumulate exclusive wall-clock time per phase.
+
+    Entering a phase pauses the enclosing one, so nested phases are never
+    counted twice.
+    """
+
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self._stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self.totals[outer[0]] += now - outer[1]
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            name, start = self._stack.pop()
+            self.totals[name] += now - start
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def timed(self, func, name):
+        """Return ``func`` wrapped so that its calls are timed as ``name``."""
+        if getattr(func, '_benchmark_phase', None):
+            return func
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+
+        wrapper.__name__ = getattr(func, '__name__', 'wrapper')
+        wrapper.__doc__ = getattr(func, '__doc__', None)
+        wrapper.__wrapped__ = func
+        wrapper._benchmark_phase = name
+        return wrapper
+
+
+def _imported_module(name):
+    """Return the module ``name`` once it has finished importing, else None.
+
+    ``patch_loaded`` also runs on the imports nested in a module's own
+    initialization, when the module is in ``sys.modules`` but its attributes
+    are not all defined yet.
+    """
+    module = sys.modules.get(name)
+    spec = getattr(module, '__spec__', None)
+    if module is None or getattr(spec, '_initializing', False):
+        return None
+    return module
+
+
+class _Instrumenter:
+    """Patch the callables in ``INSTRUMENTED`` as soon as their module has
+    been imported, so that import time itself is measured."""
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.pending = list(INSTRUMENTED)
+        self.pending_modules = list(COMPUTE_MODULES)
+        self._import = builtins.__import__
+
+    def install(self):
+        builtins.__import__ = self._timed_import
+
+    def _timed_import(self, name, *args, **kwargs):
+        with self.timer.phase('imports'):
+            module = self._import(name, *args, **kwargs)
+        self.patch_loaded()
+        return module
+
+    def patch_loaded(self):
+        for entry in list(self.pending):
+            module_name, attribute, phase = entry
+            module = _imported_module(module_name)
+            if module is None:
+                continue
+            self.pending.remove(entry)
+            *owners, name = attribute.split('.')
+            owner = module
+            try:
+                for owner_name in owners:
+                    owner = getattr(owner, owner_name)
+                setattr(owner, name, self.timer.timed(getattr(owner, name),
+                                                      phase))
+            except (AttributeError, TypeError):
+                # Not present in this version, or a built-in type
+                continue
+
+        for module_name in list(self.pending_modules):
+            module = _imported_module(module_name)
+            if module is None:
+                continue
+            self.pending_modules.remove(module_name)
+            for name in dir(module):
+                func = getattr(module, name)
+                if not name.startswith('_') and callable(func) and not isinstance(
+                        func, type):
+                    setattr(module, name, self.timer.timed(func, 'compute'))
+
+
+def _render_open_figures(timer):
+    """Rasterize and close all open figures, like sphinx-gallery's scraper."""
+    import matplotlib.pyplot as plt
+
+    with timer.phase('render'):
+        for number in plt.get_fignums():
+            plt.figure(number).savefig(io.BytesIO(), format='png')
+        plt.close('all')
+
+
+def run_child(script, output):
+    """Execute ``script`` and write its phase timings to ``output`` (JSON)."""
+    os.environ['MPLBACKEND'] = 'agg'
+    timer = PhaseTimer()
+    instrumenter = _Instrumenter(timer)
+    instrumenter.install()
+
+    script = os.path.abspath(script)
+    os.chdir(os.path.dirname(script))
+    sys.path.insert(0, os.path.dirname(script))
+
+    status = 'ok'
+    start = time.perf_counter()
+    with timer.phase('figure'):
+        import matplotlib.pyplot as plt
+
+        # Rasterize at every plt.show(), as sphinx-gallery does after each
+        # code block that produced figures
+        plt.show = lambda *args, **kwargs: _render_open_figures(timer)
+        try:
+            runpy.run_path(script, run_name='__main__')
+            _render_open_figures(timer)
+        except BaseException as err:
+            status = f'{type(err).__name__}: {err}'
+    total = time.perf_counter() - start
+
+    result = {
+        'total': total,
+        'phases': {phase: timer.totals.get(phase, 0.0) for phase in PHASES},
+        'status': status,
+    }
+    with open(output, 'w') as f:
+        json.dump(result, f)
+
+
+def benchmark_example(script, repeat=1, timeout=None):
+    """Run ``script`` ``repeat`` times in fresh processes and return the
+    fastest run."""
+    # The child runs from the repository root
+    script = os.path.abspath(script)
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'result.json')
+            command = [
+                sys.executable, '-m', 'tools.benchmark', '--child', script,
+                '--output', output
+            ]
+            try:
+                subprocess.run(command,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL,
+                               timeout=timeout,
+                               cwd=os.path.dirname(
+                                   os.path.dirname(os.path.abspath(__file__))))
+            except subprocess.TimeoutExpired:
+                return {'total': None, 'phases': {}, 'status': 'timeout'}
+            if not os.path.exists(output):
+                return {'total': None, 'phases': {}, 'status': 'crashed'}
+            with open(output) as f:
+                result = json.load(f)
+        if result['status'] != 'ok':
+            return result
+        if best is None or result['total'] < best['total']:
+            best = result
+    return best
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_regressions(run, baseline, threshold=0.25, min_seconds=0.05):
+    """Compare the results of ``run`` against ``baseline``.
+
+    A phase regresses when it is more than ``threshold`` (relative) and more
+    than ``min_seconds`` (absolute) slower than in the baseline.
+
+    Returns:
+        :class:`list`: (example, phase, baseline seconds, new seconds) tuples.
+    """
+    regressions = []
+    for example, result in sorted(run['results'].items()):
+        reference = baseline['results'].get(example)
+        if (reference is None or result['status'] != 'ok' or
+                reference['status'] != 'ok'):
+            continue
+        for phase in PHASES + ('total',):
+            new = (result['total']
+                   if phase == 'total' else result['phases'].get(phase, 0.0))
+            old = (reference['total']
+                   if phase == 'total' else reference['phases'].get(phase, 0.0))
+            if new > old * (1 + threshold) and new - old > min_seconds:
+                regressions.append((example, phase, old, new))
+    return regressions
+
+
+def _load_json(path, default):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return default
+
+
+def _dump_json(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+
+
+def _print_table(run):
+    header = f'{"example":<40}' + ''.join(
+        f'{phase:>9}' for phase in PHASES) + f'{"total":>9}'
+    print(header)
+    print('-' * len(header))
+    for example, result in sorted(run['results'].items()):
+        if result['status'] != 'ok':
+            print(f'{example:<40} {result["status"]}')
+            continue
+        print(f'{example:<40}' + ''.join(
+            f'{result["phases"][phase]:9.2f}' for phase in PHASES) +
+              f'{result["total"]:9.2f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the gallery examples phase by phase.')
+    parser.add_argument('examples',
+                        nargs='*',
+                        help='example scripts (default: Plots/**/NCL_*.py)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='runs per example; the fastest one is kept')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=600,
+                        help='seconds after which an example is abandoned')
+    parser.add_argument('--history',
+                        default=os.path.join('_build', 'benchmarks',
+                                             'history.json'))
+    parser.add_argument('--baseline',
+                        default=os.path.join('_build', 'benchmarks',
+                                             'baseline.json'))
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help='store this run as the new baseline')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.25,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--min-seconds',
+                        type=float,
+                        default=0.05,
+                        help='absolute slowdown below which nothing is '
+                        'reported')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.child, args.output)
+        return 0
+
+    examples = args.examples or sorted(
+        glob.glob(os.path.join('Plots', '**', 'NCL_*.py'), recursive=True))
+
+    run = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'results': {},
+    }
+    for example in examples:
+        print(f'benchmarking {example}...', file=sys.stderr)
+        run['results'][example] = benchmark_example(example, args.repeat,
+                                                    args.timeout)
+
+    _print_table(run)
+
+    history = _load_json(args.history, [])
+    history.append(run)
+    _dump_json(args.history, history)
+
+    status = 0
+    baseline = _load_json(args.baseline, None)
+    if baseline is not None:
+        regressions = find_regressions(run, baseline, args.threshold,
+                                       args.min_seconds)
+        for example, phase, old, new in regressions:
+            print(f'REGRESSION {example} {phase}: {old:.2f}s -> {new:.2f}s')
+        status = 1 if regressions else 0
+    if args.save_baseline or baseline is None:
+        _dump_json(args.baseline, run)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
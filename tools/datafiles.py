@@ -0,0 +1,112 @@
+"""
+Helpers to find the geocat-datafiles inputs of the example scripts.
+"""
+
+import ast
+import functools
+import hashlib
+import os
+
+import geocat.datafiles as gdf
+import pooch
+
+
+def cache_root():
+    """Return the local directory geocat-datafiles downloads files into."""
+    for value in vars(gdf).values():
+        if isinstance(value, pooch.Pooch):
+            return str(value.abspath)
+    return os.path.dirname(gdf.get("registry.txt"))
+
+
+def file_hash(path, algorithm='sha256', chunk_size=1024 * 1024):
+    """Return the hexadecimal digest of the file at ``path``."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def matches_registry(path, known_hash):
+    """Whether the file at ``path`` matches a registry hash such as
+    ``"<sha256>"`` or ``"md5:<md5>"``."""
+    algorithm, _, expected = known_hash.rpartition(':')
+    return file_hash(path, algorithm or 'sha256') == expected.lower()
+
+
+@functools.lru_cache(maxsize=None)
+def registry():
+    """Return the geocat-datafiles registry as a {file name: sha256} dictionary."""
+    hashes = {}
+    with open(gdf.get("registry.txt")) as registry_file:
+        for line in registry_file:
+            fields = line.split()
+            if len(fields) >= 2 and not fields[0].startswith('#'):
+                hashes[fields[0]] = fields[1]
+    return hashes
+
+
+def _is_datafiles_get(func):
+    """Whether ``func`` is ``gdf.get`` or ``geocat.datafiles.get``."""
+    if not (isinstance(func, ast.Attribute) and func.attr == 'get'):
+        return False
+    module = func.value
+    if isinstance(module, ast.Name):
+        return module.id == 'gdf'
+    return (isinstance(module, ast.Attribute) and module.attr == 'datafiles' and
+            isinstance(module.value, ast.Name) and module.value.id == 'geocat')
+
+
+def _datafile_name(node):
+    """Return the literal file name of a ``gdf.get("...")`` call node, or None."""
+    if (isinstance(node, ast.Call) and _is_datafiles_get(node.func) and
+            node.args and isinstance(node.args[0], ast.Constant) and
+            isinstance(node.args[0].value, str)):
+        return node.args[0].value
+    return None
+
+
+def _parse(src_file):
+    with open(src_file, encoding='utf-8') as f:
+        return ast.parse(f.read(), filename=src_file)
+
+
+def referenced_datafiles(src_file):
+    """Return the sorted data file names an example passes to ``gdf.get``.
+
+    Only string literals can be found statically; calls building the file
+    name at run time (e.g. ``gdf.get('netcdf_files/' + filename)``) are
+    skipped.
+    """
+    names = {_datafile_name(node) for node in ast.walk(_parse(src_file))}
+    names.discard(None)
+    return sorted(names)
+
+
+def open_dataset_calls(src_file):
+    """Return the ``xr.open_dataset(gdf.get("..."), **kwargs)`` calls of an
+    example as a list of (data file name, keyword arguments) tuples.
+
+    Calls whose file name or keyword arguments are not literals are skipped.
+    """
+    calls = []
+    for node in ast.walk(_parse(src_file)):
+        if not (isinstance(node, ast.Call) and
+                isinstance(node.func, ast.Attribute) and
+                node.func.attr == 'open_dataset' and
+                isinstance(node.func.value, ast.Name) and
+                node.func.value.id in ('xr', 'xarray') and
+                len(node.args) == 1):
+            continue
+        name = _datafile_name(node.args[0])
+        try:
+            kwargs = {
+                keyword.arg: ast.literal_eval(keyword.value)
+                for keyword in node.keywords
+            }
+        except ValueError:
+            continue
+        if name is not None and None not in kwargs:
+            calls.append((name, kwargs))
+    return calls
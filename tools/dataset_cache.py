@@ -0,0 +1,131 @@
+"""
+Shared in-process cache of the datasets opened by the gallery examples.
+
+Many examples open the same NetCDF files with the same decoding options
+(``netcdf_files/uv300.nc`` alone is read by more than a dozen scripts).  A
+:class:`DatasetCache` holds such datasets fully decoded in memory and stands
+in for ``xarray.open_dataset``: a call for a cached (path, keyword arguments)
+pair hands out a shallow copy of the cached dataset, so renaming, reassigning
+or dropping variables in an example never affects the cache, while every
+other call is passed through to the original, lazy ``open_dataset``.  The
+cached numpy arrays are not copied for each example: they are marked
+read-only, and an example modifying them in place fails loudly instead of
+corrupting the data seen by other examples.  Entries are evicted least
+recently used first once the cache exceeds its byte budget.
+
+The gallery runner loads the datasets opened by several examples into the
+cache of its parent process before forking the workers; the workers then
+read the decoded arrays from the memory pages inherited from the parent,
+and open every other file lazily as usual.
+"""
+
+import collections
+import os
+
+import xarray as xr
+
+from .datafiles import open_dataset_calls
+
+
+def _kwargs_key(kwargs):
+    return tuple(sorted((name, repr(value)) for name, value in kwargs.items()))
+
+
+class DatasetCache:
+    """Least recently used cache of decoded datasets, bounded in bytes.
+
+    Args:
+        max_bytes (:class:`int`):
+            Total size of the cached datasets above which the least recently
+            used ones are evicted.
+        open_dataset (:class:`callable`):
+            Function opening a dataset, the current ``xarray.open_dataset``
+            (e.g. as redirected by ``tools/rechunk.py``) by default.
+    """
+
+    def __init__(self, max_bytes, open_dataset=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._open_dataset = open_dataset or xr.open_dataset
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def key(path, kwargs):
+        """Return the cache key of opening ``path`` with ``kwargs``."""
+        path = os.path.abspath(path)
+        return path, os.path.getmtime(path), _kwargs_key(kwargs)
+
+    @staticmethod
+    def cacheable(filename_or_obj, kwargs):
+        """Whether a call can be served from the cache.
+
+        Only paths can be cached, and chunked (dask) datasets are left
+        lazy on purpose.
+        """
+        return (isinstance(filename_or_obj, (str, os.PathLike)) and
+                kwargs.get('chunks') is None and
+                kwargs.get('cache', True) is not False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, path, **kwargs):
+        """Load ``path`` into the cache (if needed) and return the cached
+        dataset, or None if it is larger than the whole byte budget."""
+        ds = self.get(path, **kwargs)
+        if ds is not None:
+            return ds
+
+        with self._open_dataset(path, **kwargs) as ds:
+            ds = ds.load()
+        if ds.nbytes > self.max_bytes:
+            return None
+        for variable in ds.variables.values():
+            variable.values.flags.writeable = False
+
+        self._entries[self.key(path, kwargs)] = ds
+        self.nbytes += ds.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return ds
+
+    def get(self, path, **kwargs):
+        """Return the cached dataset of ``path``, or None if not cached."""
+        try:
+            key = self.key(path, kwargs)
+        except OSError:
+            return None
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def open_dataset(self, filename_or_obj, **kwargs):
+        """Drop-in replacement of ``xarray.open_dataset`` serving the cached
+        datasets; files that are not cached are opened lazily as usual."""
+        if self.cacheable(filename_or_obj, kwargs):
+            ds = self.get(filename_or_obj, **kwargs)
+            if ds is not None:
+                return ds.copy(deep=False)
+        return self._open_dataset(filename_or_obj, **kwargs)
+
+    def install(self):
+        """Make ``xarray.open_dataset`` (as called by the examples) use the cache."""
+        xr.open_dataset = self.open_dataset
+
+
+def shared_datasets(src_files, min_uses=2):
+    """Return the (data file name, keyword arguments) pairs opened by at least
+    ``min_uses`` of the examples ``src_files``, most used first."""
+    uses = collections.Counter()
+    calls = {}
+    for src_file in src_files:
+        keys = set()
+        for name, kwargs in open_dataset_calls(src_file):
+            key = (name, _kwargs_key(kwargs))
+            calls[key] = (name, kwargs)
+            keys.add(key)
+        # Count each distinct call once per example
+        uses.update(keys)
+    return [calls[key] for key, count in uses.most_common() if count >= min_uses]
@@ -0,0 +1,157 @@
+"""
+Content-addressed cache of executed gallery examples.
+
+Every example is identified by a key hashing its source code, the registry
+checksums of the data files it fetches through ``geocat.datafiles``, the
+versions of the packages that produce its figures and the sphinx-gallery
+settings that determine its outputs (image scrapers and their formats,
+thumbnail size...).  After an example has been executed, its sphinx-gallery
+outputs (copied script and checksum, rst, notebook, images and thumbnail) are
+stored under that key; when the key is unchanged in a later build the outputs
+are copied back instead of running the example again.
+
+The cache is used by ``tools/gallery_runner.py`` and lives in the directory
+given by the ``gallery_cache_dir`` configuration value (empty by default,
+which disables it; e.g. ``_build/gallery_cache``).
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+from .datafiles import referenced_datafiles, registry
+
+try:
+    from importlib.metadata import PackageNotFoundError, version
+except ImportError:  # Python < 3.8
+    import pkg_resources
+
+    PackageNotFoundError = pkg_resources.DistributionNotFound
+
+    def version(name):
+        return pkg_resources.get_distribution(name).version
+
+
+# Packages whose versions are part of every cache key
+KEY_PACKAGES = ('geocat-comp', 'geocat-viz', 'geocat-datafiles', 'matplotlib',
+                'cartopy', 'sphinx-gallery')
+
+
+def package_versions(packages=KEY_PACKAGES):
+    """Return a {package: version} dictionary; missing packages map to None."""
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def example_outputs(target_dir, fname):
+    """Return the paths, relative to ``target_dir``, of the sphinx-gallery
+    outputs of the example ``fname``."""
+    name = os.path.splitext(fname)[0]
+    candidates = [
+        fname, fname + '.md5', name + '.rst', name + '.ipynb',
+        name + '_codeobj.pickle'
+    ]
+    outputs = [
+        path for path in candidates
+        if os.path.isfile(os.path.join(target_dir, path))
+    ]
+
+    image_pattern = re.compile(r'^sphx_glr_' + re.escape(name) +
+                               r'_(\d{3}\w*|thumb)\.\w+$')
+    for image_dir in ('images', os.path.join('images', 'thumb')):
+        if not os.path.isdir(os.path.join(target_dir, image_dir)):
+            continue
+        outputs.extend(
+            os.path.join(image_dir, image)
+            for image in sorted(os.listdir(os.path.join(target_dir, image_dir)))
+            if image_pattern.match(image))
+    return outputs
+
+
+# sphinx-gallery settings that change the outputs of an example
+OUTPUT_SETTINGS = ('image_scrapers', 'compress_images', 'thumbnail_size',
+                   'image_srcset', 'first_notebook_cell', 'last_notebook_cell',
+                   'line_numbers', 'remove_config_comments')
+
+
+def output_settings(gallery_conf):
+    """Return the representation of the output settings of ``gallery_conf``
+    that is part of every cache key."""
+    return '\n'.join(f'{name}={gallery_conf.get(name)!r}'
+                     for name in OUTPUT_SETTINGS)
+
+
+class GalleryCache:
+    """Persistent store of example outputs keyed by the example's inputs.
+
+    Args:
+        cache_dir (:class:`str`):
+            Directory holding the cache entries; it is created if necessary.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._versions = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, src_file, settings=''):
+        """Return the hexadecimal cache key of the example script ``src_file``
+        built with the ``settings`` returned by :func:`output_settings`."""
+        if self._versions is None:
+            self._versions = sorted(package_versions().items())
+
+        digest = hashlib.sha256(settings.encode())
+        with open(src_file, 'rb') as f:
+            digest.update(f.read())
+        hashes = registry()
+        for datafile in referenced_datafiles(src_file):
+            digest.update(f'{datafile}={hashes.get(datafile)}\n'.encode())
+        for package, package_version in self._versions:
+            digest.update(f'{package}=={package_version}\n'.encode())
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def restore(self, key, target_dir, fname):
+        """Copy the cached outputs of ``fname`` into ``target_dir``.
+
+        Returns:
+            :class:`bool`: whether the cache held an entry for ``key``.
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        for path in example_outputs(entry, fname):
+            destination = os.path.join(target_dir, path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            # Restored files get a fresh modification time, so Sphinx
+            # re-reads the restored rst pages
+            shutil.copyfile(os.path.join(entry, path), destination)
+        return True
+
+    def store(self, key, target_dir, fname):
+        """Store the outputs of ``fname`` found in ``target_dir`` under ``key``."""
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        # Populate a temporary directory and rename it, so that an
+        # interrupted build never leaves a partial entry behind
+        staging = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            for path in example_outputs(target_dir, fname):
+                destination = os.path.join(staging, path)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copy2(os.path.join(target_dir, path), destination)
+            os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,282 @@
+"""
+Sphinx extension that executes the gallery examples in a process pool.
+
+Sphinx-gallery runs every example script one after another inside the Sphinx
+process.  When ``gallery_jobs`` is larger than one or the build cache is
+enabled, this extension runs just before sphinx-gallery and executes the
+example scripts in a pool of worker processes, one script per freshly forked
+worker so that every example starts from a clean matplotlib state.  Each
+worker writes exactly the outputs sphinx-gallery would (rst, images,
+thumbnails, notebooks and ``.md5`` checksums), so the regular sphinx-gallery
+pass that follows finds every example up to date and only assembles the
+gallery index pages, in the ``within_subsection_order`` configured in
+``conf.py``.
+
+Usage, from the root directory of the repository::
+
+    make html SPHINXOPTS="-D gallery_jobs=8"
+
+or set the ``GALLERY_JOBS`` environment variable read by ``conf.py``.
+
+Unless ``gallery_cache_dir`` is empty, examples whose script, input data files
+and package versions are unchanged since a previous build are restored from
+the cache in ``tools/gallery_cache.py`` instead of being executed.
+
+Before the workers are forked, the parent process imports the modules listed
+in ``gallery_preload_modules`` and warms up matplotlib and cartopy (see
+``tools/preload.py``), so that the examples start in milliseconds.
+
+The parent also loads the datasets that several examples open with
+``xr.open_dataset`` into a cache (``tools/dataset_cache.py``) bounded by
+``gallery_dataset_cache_bytes``; the workers read these datasets from the
+memory inherited from the parent and open every other file lazily.
+
+Setting ``gallery_memory_report`` profiles the memory used by every executed
+example (see ``tools/memory_report.py``).
+"""
+
+import contextlib
+import multiprocessing
+import os
+import re
+
+from sphinx.util import logging
+
+from .dataset_cache import DatasetCache, shared_datasets
+from .gallery_cache import GalleryCache, output_settings
+from .memory_report import MemoryProfiler, write_report
+from .preload import DEFAULT_MODULES, preload_and_warm_up
+
+logger = logging.getLogger(__name__)
+
+# Completed sphinx-gallery configuration.  It is a module global, rather than
+# an argument, so that forked workers inherit it without pickling the Sphinx
+# application object it refers to.
+_gallery_conf = None
+
+# Whether workers profile the memory of the examples, and the profiles
+# collected during this build
+_memory_report = False
+_memory_profiles = []
+
+# Datasets shared by the examples, loaded before the workers are forked
+_dataset_cache = None
+
+
+def parse_gallery_conf(app):
+    """Return the completed sphinx-gallery configuration without side effects.
+
+    ``sphinx_gallery.gen_gallery.parse_config`` replaces the user configuration
+    and extends ``html_static_path``; both are restored here so that the
+    sphinx-gallery pass later in the build sees the configuration untouched.
+    """
+    from sphinx_gallery.gen_gallery import parse_config
+
+    raw_conf = app.config.sphinx_gallery_conf
+    static_path = list(app.config.html_static_path)
+    gallery_conf = parse_config(app)
+    app.config.sphinx_gallery_conf = raw_conf
+    app.config.html_static_path[:] = static_path
+    return gallery_conf
+
+
+def _as_list(dirs):
+    return [dirs] if isinstance(dirs, str) else list(dirs)
+
+
+def gallery_sections(gallery_conf):
+    """Yield (source directory, target directory) pairs of every gallery
+    section."""
+    src_root = gallery_conf['src_dir']
+    for examples_dir, gallery_dir in zip(
+            _as_list(gallery_conf['examples_dirs']),
+            _as_list(gallery_conf['gallery_dirs'])):
+        examples_dir = os.path.join(src_root, examples_dir)
+        gallery_dir = os.path.join(src_root, gallery_dir)
+        yield examples_dir, gallery_dir
+
+        # Sphinx-gallery treats every sub-directory with a README as a section
+        for subsection in sorted(os.listdir(examples_dir)):
+            src_dir = os.path.join(examples_dir, subsection)
+            if os.path.isdir(src_dir) and any(
+                    os.path.exists(os.path.join(src_dir, readme))
+                    for readme in ('README.txt', 'README.rst')):
+                yield src_dir, os.path.join(gallery_dir, subsection)
+
+
+def collect_examples(gallery_conf):
+    """Return (file name, source directory, target directory) of every example
+    that sphinx-gallery would execute."""
+    examples = []
+    for src_dir, target_dir in gallery_sections(gallery_conf):
+        for fname in sorted(os.listdir(src_dir)):
+            src_file = os.path.normpath(os.path.join(src_dir, fname))
+            ignored = re.search(gallery_conf['ignore_pattern'], fname)
+            if (fname.endswith('.py') and ignored is None and
+                    re.search(gallery_conf['filename_pattern'], src_file)):
+                examples.append((fname, src_dir, target_dir))
+    return examples
+
+
+def invalidate_example(target_dir, fname):
+    """Remove the checksum of an example so that sphinx-gallery runs it
+    again."""
+    md5_file = os.path.join(target_dir, fname + '.md5')
+    if os.path.exists(md5_file):
+        os.remove(md5_file)
+
+
+def _run_example(example):
+    """Execute a single example in a worker process.
+
+    Returns the example, its sphinx-gallery cost tuple (time, memory),
+    whether the example failed and its memory profile (or None).
+    """
+    from sphinx_gallery.gen_rst import generate_file_rst
+
+    fname, src_dir, target_dir = example
+    src_file = os.path.normpath(os.path.join(src_dir, fname))
+    if _dataset_cache is not None:
+        _dataset_cache.install()
+    profiler = (MemoryProfiler(src_file)
+                if _memory_report else contextlib.nullcontext())
+    try:
+        with profiler:
+            _, _, cost = generate_file_rst(fname, target_dir, src_dir,
+                                           _gallery_conf)
+    except Exception:
+        # Raised when abort_on_example_error is set; the sphinx-gallery pass
+        # runs the example again and reports the error properly
+        return example, (0, 0), True, None
+    profile = profiler.result() if _memory_report else None
+    return (example, cost, src_file in _gallery_conf['failing_examples'],
+            profile)
+
+
+def load_shared_datasets(examples, max_bytes):
+    """Return a dataset cache holding the datasets opened by several
+    examples."""
+    import geocat.datafiles as gdf
+
+    cache = DatasetCache(max_bytes)
+    src_files = [
+        os.path.join(src_dir, fname) for fname, src_dir, _ in examples
+    ]
+    for name, kwargs in shared_datasets(src_files):
+        try:
+            cache.load(gdf.get(name), **kwargs)
+        except Exception as err:
+            logger.warning(f'could not cache {name}: {err}')
+    logger.info(f'cached {len(cache)} shared datasets '
+                f'({cache.nbytes / 2**20:.0f} MB) for the gallery workers')
+    return cache
+
+
+def run_examples(app):
+    """Execute all gallery examples in a pool of ``gallery_jobs`` processes."""
+    global _gallery_conf, _memory_report, _dataset_cache
+
+    jobs = max(app.config.gallery_jobs, 1)
+    cache = None
+    if app.config.gallery_cache_dir:
+        cache = GalleryCache(
+            os.path.join(app.srcdir, app.config.gallery_cache_dir))
+    _memory_report = bool(app.config.gallery_memory_report)
+    if jobs == 1 and cache is None and not _memory_report:
+        return
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning('gallery_jobs, gallery_cache_dir and '
+                       'gallery_memory_report require the "fork" start '
+                       'method; executing gallery examples serially')
+        return
+
+    _gallery_conf = parse_gallery_conf(app)
+    if not _gallery_conf['plot_gallery']:
+        return
+
+    examples = collect_examples(_gallery_conf)
+    for target_dir in {target_dir for _, _, target_dir in examples}:
+        os.makedirs(os.path.join(target_dir, 'images', 'thumb'), exist_ok=True)
+
+    keys = {}
+    if cache is not None:
+        pending = []
+        settings = output_settings(_gallery_conf)
+        for example in examples:
+            fname, src_dir, target_dir = example
+            keys[example] = cache.key(os.path.join(src_dir, fname), settings)
+            if not cache.restore(keys[example], target_dir, fname):
+                # The outputs on disk may have been produced from other data
+                # files or package versions; make sphinx-gallery run it again
+                invalidate_example(target_dir, fname)
+                pending.append(example)
+        logger.info(f'restored {len(examples) - len(pending)} gallery '
+                    'examples from the build cache',
+                    color='white')
+        examples = pending
+
+    if not examples:
+        return
+
+    # Workers are forked from this process, so they inherit everything
+    # imported and initialized here
+    preload_and_warm_up(app.config.gallery_preload_modules)
+    if app.config.gallery_dataset_cache_bytes > 0:
+        _dataset_cache = load_shared_datasets(
+            examples, app.config.gallery_dataset_cache_bytes)
+
+    logger.info(f'executing {len(examples)} gallery examples with '
+                f'{jobs} processes...',
+                color='white')
+
+    # A new worker is forked for every example (maxtasksperchild=1), so no
+    # matplotlib or module state leaks from one example into the next
+    costs = {}
+    context = multiprocessing.get_context('fork')
+    with context.Pool(jobs, maxtasksperchild=1) as pool:
+        for example, cost, failed, profile in pool.imap_unordered(
+                _run_example, examples):
+            fname, src_dir, target_dir = example
+            if profile is not None:
+                _memory_profiles.append(profile)
+            if failed:
+                invalidate_example(target_dir, fname)
+                logger.warning(f'{fname} failed in a gallery worker; '
+                               'it will be run again by sphinx-gallery')
+                continue
+            costs.setdefault(target_dir, []).append(
+                (cost, os.path.normpath(os.path.join(src_dir, fname))))
+            if cache is not None:
+                cache.store(keys[example], target_dir, fname)
+
+    # Examples that are up to date make sphinx-gallery skip writing the
+    # execution times, so the times measured by the workers are kept
+    from sphinx_gallery.gen_gallery import write_computation_times
+    for target_dir, dir_costs in costs.items():
+        write_computation_times(_gallery_conf, target_dir, dir_costs)
+
+
+def write_memory_report(app, exception):
+    """Write the memory profiles collected by the workers next to the
+    gallery."""
+    if exception is not None or not _memory_profiles:
+        return
+    gallery_dir = _as_list(_gallery_conf['gallery_dirs'])[0]
+    out_dir = os.path.join(app.outdir, gallery_dir)
+    write_report(_memory_profiles, out_dir, _gallery_conf['src_dir'])
+    logger.info('gallery memory report written to ' +
+                os.path.join(out_dir, 'memory_report.html'))
+
+
+def setup(app):
+    app.add_config_value('gallery_jobs', 1, '')
+    app.add_config_value('gallery_cache_dir', '', '')
+    app.add_config_value('gallery_memory_report', False, '')
+    app.add_config_value('gallery_preload_modules', DEFAULT_MODULES, '')
+    app.add_config_value('gallery_dataset_cache_bytes', 2**30, '')
+
+    # Run before sphinx-gallery's own builder-inited handler (priority 500)
+    app.connect('builder-inited', run_examples, priority=400)
+    app.connect('build-finished', write_memory_report)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,235 @@
+"""
+Peak memory and allocation profiling of the gallery examples.
+
+When the ``gallery_memory_report`` configuration value is set, the gallery
+runner (``tools/gallery_runner.py``) executes every example under a
+:class:`MemoryProfiler`, which records
+
+    - the peak resident set size of the worker process,
+    - the peak of the memory traced by :mod:`tracemalloc`, and
+    - the allocation sites holding the most memory, taken from a snapshot
+      at the end of the code block with the largest traced memory.
+      Allocations are attributed to the line of the example script that
+      triggered them, falling back to the library line that made them.
+
+At the end of the build the results are written to ``memory_report.json``
+and a sortable ``memory_report.html`` in the gallery output directory.
+
+Usage, from the root directory of the repository::
+
+    make html SPHINXOPTS="-D gallery_memory_report=1"
+"""
+
+import html
+import json
+import os
+import sys
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MB = 1024 * 1024
+
+# Number of stack frames stored per traced allocation
+TRACEBACK_FRAMES = 25
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in bytes."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class MemoryProfiler:
+    """Context manager profiling the memory used by one gallery example.
+
+    Args:
+        src_file (:class:`str`):
+            Path of the example script; allocations are attributed to lines
+            of this file whenever it appears in their traceback.
+        top (:class:`int`):
+            Number of allocation sites to report.
+    """
+
+    def __init__(self, src_file, top=10):
+        self.src_file = os.path.normpath(src_file)
+        self.top = top
+        self._snapshot = None
+        self._snapshot_size = -1
+
+    def __enter__(self):
+        from sphinx_gallery import gen_rst
+
+        self._gen_rst = gen_rst
+        self._execute_code_block = gen_rst.execute_code_block
+        self.start_rss = peak_rss()
+
+        def execute_code_block(*args, **kwargs):
+            result = self._execute_code_block(*args, **kwargs)
+            self._checkpoint()
+            return result
+
+        gen_rst.execute_code_block = execute_code_block
+        tracemalloc.start(TRACEBACK_FRAMES)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self._gen_rst.execute_code_block = self._execute_code_block
+        return False
+
+    def _checkpoint(self):
+        """Keep a snapshot of the largest traced memory seen at a block end."""
+        current = tracemalloc.get_traced_memory()[0]
+        if current > self._snapshot_size:
+            self._snapshot_size = current
+            self._snapshot = tracemalloc.take_snapshot()
+
+    def _site(self, traceback):
+        """Return the (file, line) an allocation is attributed to."""
+        # Frames are ordered from the oldest to the most recent call
+        for frame in reversed(traceback):
+            if os.path.normpath(frame.filename) == self.src_file:
+                return frame.filename, frame.lineno
+        return traceback[-1].filename, traceback[-1].lineno
+
+    def top_allocations(self):
+        """Return the largest allocation sites of the heaviest snapshot."""
+        if self._snapshot is None:
+            return []
+        snapshot = self._snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        sites = {}
+        for stat in snapshot.statistics('traceback'):
+            site = self._site(stat.traceback)
+            size, count = sites.get(site, (0, 0))
+            sites[site] = (size + stat.size, count + stat.count)
+
+        largest = sorted(sites.items(), key=lambda item: -item[1][0])
+        return [{
+            'file': filename,
+            'line': lineno,
+            'size_mb': size / MB,
+            'count': count,
+        } for (filename, lineno), (size, count) in largest[:self.top]]
+
+    def result(self):
+        """Return the measurements as a JSON serializable dictionary."""
+        end_rss = peak_rss()
+        return {
+            'example': self.src_file,
+            'peak_rss_mb': end_rss / MB if end_rss is not None else None,
+            'rss_increase_mb': ((end_rss - self.start_rss) /
+                                MB if end_rss is not None else None),
+            'traced_peak_mb': self._traced_peak / MB,
+            'top_allocations': self.top_allocations(),
+        }
+
+
+_HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Gallery memory report</title>
+<style>
+table {{ border-collapse: collapse; font-family: sans-serif; font-size: 13px; }}
+th, td {{ border: 1px solid #ccc; padding: 4px 8px; vertical-align: top; }}
+th {{ background: #eee; cursor: pointer; }}
+td.number {{ text-align: right; }}
+details {{ font-family: monospace; }}
+</style>
+</head>
+<body>
+<h1>Gallery memory report</h1>
+<p>Click on a column header to sort the table.</p>
+<table id="report">
+<thead><tr>
+<th>Example</th><th>Peak RSS (MB)</th><th>RSS increase (MB)</th>
+<th>Traced peak (MB)</th><th>Top allocation sites</th>
+</tr></thead>
+<tbody>
+{rows}
+</tbody>
+</table>
+<script>
+document.querySelectorAll('#report th').forEach(function (th, column) {{
+  th.addEventListener('click', function () {{
+    var tbody = document.querySelector('#report tbody');
+    var rows = Array.from(tbody.rows);
+    var descending = th.dataset.order !== 'desc';
+    th.dataset.order = descending ? 'desc' : 'asc';
+    rows.sort(function (a, b) {{
+      var x = a.cells[column].dataset.value, y = b.cells[column].dataset.value;
+      var cmp = isNaN(x) || isNaN(y) ? x.localeCompare(y) : x - y;
+      return descending ? -cmp : cmp;
+    }});
+    rows.forEach(function (row) {{ tbody.appendChild(row); }});
+  }});
+}});
+</script>
+</body>
+</html>
+"""
+
+
+def _number_cell(value):
+    if value is None:
+        return '<td class="number" data-value="0">n/a</td>'
+    return f'<td class="number" data-value="{value:.3f}">{value:.1f}</td>'
+
+
+def write_report(profiles, out_dir, src_dir=''):
+    """Write (and merge with any previous) memory report into ``out_dir``.
+
+    Args:
+        profiles (:class:`list`):
+            :meth:`MemoryProfiler.result` dictionaries of the examples that
+            were executed in this build.
+        out_dir (:class:`str`):
+            Directory receiving ``memory_report.json`` and ``memory_report.html``.
+        src_dir (:class:`str`):
+            Example paths are reported relative to this directory.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    json_file = os.path.join(out_dir, 'memory_report.json')
+
+    # Keep the measurements of examples that were not executed this time,
+    # e.g. because they were restored from the build cache
+    report = {}
+    if os.path.exists(json_file):
+        with open(json_file) as f:
+            report = {entry['example']: entry for entry in json.load(f)}
+    for profile in profiles:
+        profile = dict(profile,
+                       example=os.path.relpath(profile['example'], src_dir))
+        report[profile['example']] = profile
+
+    entries = sorted(report.values(),
+                     key=lambda entry: -(entry['peak_rss_mb'] or 0))
+    with open(json_file, 'w') as f:
+        json.dump(entries, f, indent=1)
+
+    rows = []
+    for entry in entries:
+        sites = ''.join(
+            f'<div>{site["size_mb"]:8.1f} MB  {html.escape(site["file"])}:'
+            f'{site["line"]}</div>' for site in entry['top_allocations'])
+        example = html.escape(entry['example'])
+        rows.append(f'<tr><td data-value="{example}">{example}</td>' +
+                    _number_cell(entry['peak_rss_mb']) +
+                    _number_cell(entry['rss_increase_mb']) +
+                    _number_cell(entry['traced_peak_mb']) +
+                    '<td data-value="">' +
+                    f'<details><summary>{len(entry["top_allocations"])} '
+                    f'sites</summary>{sites}</details></td></tr>')
+    with open(os.path.join(out_dir, 'memory_report.html'), 'w') as f:
+        f.write(_HTML_TEMPLATE.format(rows='\n'.join(rows)))
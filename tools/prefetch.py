@@ -0,0 +1,198 @@
+"""
+Bulk prefetch of the geocat-datafiles inputs of the gallery examples.
+
+The example scripts fetch their NetCDF, shapefile and ASCII inputs lazily,
+one ``gdf.get`` call at a time.  This module finds every data file named in a
+``gdf.get(...)`` call of the example scripts and resolves all of them up
+front with a thread pool, so that no example blocks on a download during the
+build.
+
+Files are taken from a local mirror directory when one is given (laid out
+like the geocat-datafiles repository, e.g. ``<mirror>/netcdf_files/uv300.nc``),
+which allows building on offline machines; otherwise they are downloaded
+through ``geocat.datafiles``.  Every file is checked against the registry
+checksum when it is resolved and recorded, with its size and modification
+time, in a manifest, so that later prefetches skip hashing unchanged files.
+The manifest only speeds up the prefetch itself: the ``gdf.get`` calls of the
+examples still let pooch hash each file again when the example runs.
+
+As a Sphinx extension the prefetch runs at the start of every build (with
+``gallery_prefetch_jobs`` threads and the ``gallery_data_mirror`` directory).
+It can also be run on its own, from the root directory of the repository::
+
+    python -m tools.prefetch --jobs 16 --mirror /path/to/GeoCAT-datafiles
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import shutil
+import sys
+
+import geocat.datafiles as gdf
+
+from .datafiles import (cache_root, matches_registry, referenced_datafiles,
+                        registry)
+
+MANIFEST = os.path.join('_build', 'datafiles_manifest.json')
+
+
+def collect_datafiles(examples_dir='Plots'):
+    """Return the sorted data file names fetched by the example scripts."""
+    names = set()
+    for script in glob.glob(os.path.join(examples_dir, '**', '*.py'),
+                            recursive=True):
+        names.update(referenced_datafiles(script))
+    return sorted(names)
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _resolve(name, root, hashes, manifest, mirror):
+    """Make ``name`` available in the local cache and return its manifest
+    entry."""
+    local = os.path.join(root, name)
+    known_hash = hashes.get(name)
+
+    entry = manifest.get(name)
+    if (entry is not None and os.path.exists(local) and
+            entry.get('hash') == known_hash and entry.get('path') == local and
+            {key: entry.get(key) for key in ('size', 'mtime')} == _stat(local)):
+        return entry
+
+    if known_hash is None:
+        raise KeyError(f'{name} is not in the geocat-datafiles registry')
+
+    if not (os.path.exists(local) and matches_registry(local, known_hash)):
+        mirrored = os.path.join(mirror, name) if mirror else None
+        if mirrored and os.path.exists(mirrored):
+            if not matches_registry(mirrored, known_hash):
+                raise ValueError(f'{mirrored} does not match the registry '
+                                 'checksum')
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            shutil.copyfile(mirrored, local)
+        else:
+            # Downloads and verifies the file against the registry
+            local = gdf.get(name)
+
+    return dict(_stat(local), path=local, hash=known_hash)
+
+
+def prefetch(names, jobs=8, mirror=None, manifest_file=MANIFEST):
+    """Resolve the data files ``names`` concurrently.
+
+    Args:
+        names (:class:`list`):
+            Data file names, relative to the geocat-datafiles repository.
+        jobs (:class:`int`):
+            Number of threads fetching files.
+        mirror (:class:`str`):
+            Optional local copy of the geocat-datafiles repository that is
+            used instead of downloading.
+        manifest_file (:class:`str`):
+            JSON file recording the files that were verified.
+
+    Returns:
+        :class:`dict`: {name: error message} of the files that could not be
+        resolved.
+    """
+    root = cache_root()
+
+    # The registry itself has no checksum; take it from the mirror if needed
+    registry_file = os.path.join(root, 'registry.txt')
+    if mirror and not os.path.exists(registry_file):
+        os.makedirs(root, exist_ok=True)
+        shutil.copyfile(os.path.join(mirror, 'registry.txt'), registry_file)
+
+    hashes = registry()
+
+    manifest = {}
+    if manifest_file and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(_resolve, name, root, hashes, manifest, mirror):
+                name for name in names
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                manifest[name] = future.result()
+            except Exception as err:
+                manifest.pop(name, None)
+                errors[name] = f'{type(err).__name__}: {err}'
+
+    if manifest_file:
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_file)),
+                    exist_ok=True)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return errors
+
+
+def prefetch_datafiles(app):
+    """Sphinx ``builder-inited`` handler prefetching the gallery inputs."""
+    from sphinx.util import logging
+
+    logger = logging.getLogger(__name__)
+    if app.config.gallery_prefetch_jobs <= 0:
+        return
+
+    examples_dirs = app.config.sphinx_gallery_conf.get('examples_dirs', [])
+    if isinstance(examples_dirs, str):
+        examples_dirs = [examples_dirs]
+    names = []
+    for examples_dir in examples_dirs:
+        names.extend(collect_datafiles(os.path.join(app.srcdir,
+                                                    examples_dir)))
+    names = sorted(set(names))
+    logger.info(f'prefetching {len(names)} gallery data files with '
+                f'{app.config.gallery_prefetch_jobs} threads...',
+                color='white')
+    errors = prefetch(names,
+                      jobs=app.config.gallery_prefetch_jobs,
+                      mirror=app.config.gallery_data_mirror or None,
+                      manifest_file=os.path.join(app.srcdir, MANIFEST))
+    for name, error in sorted(errors.items()):
+        logger.warning(f'could not prefetch {name}: {error}')
+
+
+def setup(app):
+    app.add_config_value('gallery_prefetch_jobs', 8, '')
+    app.add_config_value('gallery_data_mirror', '', '')
+
+    # Run before the gallery runner (priority 400) and sphinx-gallery (500)
+    app.connect('builder-inited', prefetch_datafiles, priority=300)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Prefetch the data files used by the gallery examples.')
+    parser.add_argument('--examples-dir', default='Plots')
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--mirror',
+                        default=os.environ.get('GEOCAT_DATA_MIRROR'),
+                        help='local copy of the geocat-datafiles repository')
+    parser.add_argument('--manifest', default=MANIFEST)
+    args = parser.parse_args(argv)
+
+    names = collect_datafiles(args.examples_dir)
+    errors = prefetch(names, args.jobs, args.mirror, args.manifest)
+    print(f'{len(names) - len(errors)} of {len(names)} data files available')
+    for name, error in sorted(errors.items()):
+        print(f'{name}: {error}', file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
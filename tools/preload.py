@@ -0,0 +1,96 @@
+"""
+Warm-up of the gallery runner's parent process.
+
+The gallery runner forks one worker per example.  Importing the scientific
+stack once in the parent, before any worker is forked, makes every
+``import`` in the examples a dictionary lookup in ``sys.modules``, and the
+memory pages of the imported modules are shared copy-on-write between the
+workers.  Besides the imports, :func:`warm_up` initializes state that is
+otherwise built lazily by the first figure of every example: the matplotlib
+font cache and mathtext fonts, the Agg renderer and the PROJ context behind
+cartopy's coordinate reference systems.
+"""
+
+import importlib
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+# Modules imported by the examples; those not installed are skipped
+DEFAULT_MODULES = [
+    'numpy',
+    'pandas',
+    'xarray',
+    'netCDF4',
+    'scipy.ndimage',
+    'scipy.spatial',
+    'matplotlib.pyplot',
+    'cartopy.crs',
+    'cartopy.feature',
+    'cartopy.mpl.geoaxes',
+    'geocat.datafiles',
+    'geocat.comp',
+    'geocat.viz.util',
+    'geocat.viz.cmaps',
+    'shapefile',
+    'metpy.calc',
+    'metpy.plots',
+    'wrf',
+]
+
+
+def preload(modules=DEFAULT_MODULES):
+    """Import ``modules`` and return the names of those that were imported."""
+    # Select the non-interactive backend before pyplot is imported
+    import matplotlib
+    matplotlib.use('agg')
+
+    loaded = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        loaded.append(name)
+    return loaded
+
+
+def warm_up():
+    """Initialize the lazily built state of matplotlib and cartopy."""
+    from matplotlib import font_manager
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    font_manager.findfont('DejaVu Sans')
+
+    # Draw regular and mathtext labels once to load the fonts and glyph caches
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_title('Warm-up')
+    ax.text(0.5, 0.5, r'L$_{996}$ $^\circ$C')
+    fig.canvas.draw()
+
+    try:
+        import cartopy.crs as ccrs
+    except ImportError:
+        return
+    import numpy as np
+
+    points = np.array([0.0, 10.0])
+    source = ccrs.PlateCarree()
+    for crs in (ccrs.Orthographic(central_longitude=270, central_latitude=45),
+                ccrs.LambertConformal(), ccrs.Robinson()):
+        crs.transform_points(source, points, points)
+
+
+def preload_and_warm_up(modules=DEFAULT_MODULES):
+    """Preload ``modules`` and warm up matplotlib and cartopy."""
+    loaded = preload(modules)
+    try:
+        warm_up()
+    except Exception as err:
+        # A failed warm-up only costs time in the workers
+        logger.warning(f'gallery worker warm-up failed: {err}')
+    logger.info(f'preloaded {len(loaded)} modules for the gallery workers')
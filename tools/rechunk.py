@@ -0,0 +1,254 @@
+"""
+Chunked Zarr copies of the NetCDF inputs of the gallery examples.
+
+Most examples read a single slice of a multi-dimensional file, e.g.
+``ds.slp[24, :, :]`` from ``slp.1963.nc`` or ``ds.T.isel(time=0, z_t=0)``
+from the ocean history file, but the NetCDF files are stored contiguously or
+with chunks that do not match these reads.  This module converts the data
+files referenced by the examples into a Zarr store in which every variable
+is chunked for slicing along its leading dimensions: the horizontal (lat/lon
+or y/x) dimensions are kept whole, and the other dimensions are split in
+chunks of one, or a few, horizontal fields.  Reading one field then only
+decompresses the chunk holding it.
+
+The data are copied without CF decoding, so a converted file can be opened
+with any of the decoding options of ``xarray.open_dataset``.  Every store
+records the registry checksum of the file it was converted from, and stale
+or missing conversions are simply not used.
+
+Convert the data files, from the root directory of the repository::
+
+    python -m tools.rechunk
+
+As a Sphinx extension, :func:`install` then redirects the
+``xr.open_dataset(gdf.get(...))`` calls of the examples to the converted
+stores (``gallery_zarr_store`` in ``conf.py``).
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+
+import xarray as xr
+
+from .datafiles import cache_root, registry
+from .prefetch import collect_datafiles
+
+STORE = os.path.join('_build', 'zarr_store')
+INDEX = 'index.json'
+
+# Dimensions kept whole in every chunk
+HORIZONTAL_DIMS = {
+    'lat', 'lon', 'latitude', 'longitude', 'nlat', 'nlon', 'x', 'y', 'rlat',
+    'rlon', 'south_north', 'west_east', 'ncol'
+}
+
+# Chunks smaller than this hold several horizontal fields
+MIN_CHUNK_BYTES = 256 * 1024
+
+# Decoding options of xarray.open_dataset that xarray.open_zarr accepts too
+ZARR_OPTIONS = {
+    'decode_cf', 'mask_and_scale', 'decode_times', 'concat_characters',
+    'decode_coords', 'drop_variables', 'use_cftime', 'decode_timedelta'
+}
+
+
+def variable_chunks(variable):
+    """Return the Zarr chunk shape of a variable.
+
+    The horizontal dimensions (or the two trailing dimensions when none is
+    recognized) are kept whole; the other dimensions are split in chunks of
+    one field, grown along the innermost of them to at least
+    ``MIN_CHUNK_BYTES``.
+    """
+    horizontal = [dim in HORIZONTAL_DIMS for dim in variable.dims]
+    if not any(horizontal):
+        horizontal = [axis >= variable.ndim - 2 for axis in range(variable.ndim)]
+    chunks = [
+        size if whole else 1 for size, whole in zip(variable.shape, horizontal)
+    ]
+
+    leading = [axis for axis, whole in enumerate(horizontal) if not whole]
+    if leading:
+        field_bytes = variable.dtype.itemsize * math.prod(chunks)
+        axis = leading[-1]
+        chunks[axis] = min(variable.shape[axis],
+                           max(1, MIN_CHUNK_BYTES // max(field_bytes, 1)))
+    return tuple(max(chunk, 1) for chunk in chunks)
+
+
+def convert(path, store):
+    """Write a chunked Zarr copy of the NetCDF file ``path`` to ``store``."""
+    with xr.open_dataset(path, decode_cf=False) as ds:
+        encoding = {
+            name: {'chunks': variable_chunks(variable)}
+            for name, variable in ds.variables.items()
+        }
+        for variable in ds.variables.values():
+            variable.encoding = {}
+
+        # Write next to the store and swap it in, so that an interrupted
+        # conversion never leaves a partial store behind
+        partial = store + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        ds.to_zarr(partial, mode='w', encoding=encoding, consolidated=True)
+    shutil.rmtree(store, ignore_errors=True)
+    os.rename(partial, store)
+
+
+def _read_index(store_dir):
+    index_file = os.path.join(store_dir, INDEX)
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def convert_datafiles(names, store_dir=STORE, force=False):
+    """Convert the NetCDF data files ``names`` into chunked Zarr stores.
+
+    Args:
+        names (:class:`list`):
+            Data file names, relative to the geocat-datafiles repository;
+            names that are not NetCDF files are skipped.
+        store_dir (:class:`str`):
+            Directory receiving one ``<name>.zarr`` store per data file and
+            the ``index.json`` of the converted files.
+        force (:class:`bool`):
+            Convert again the files that are already up to date.
+
+    Returns:
+        :class:`dict`: {name: error message} of the files that could not be
+        converted.
+    """
+    import geocat.datafiles as gdf
+
+    hashes = registry()
+    index = _read_index(store_dir)
+    errors = {}
+    for name in names:
+        if not name.endswith('.nc'):
+            continue
+        entry = index.get(name)
+        store = os.path.join(store_dir, os.path.splitext(name)[0] + '.zarr')
+        if (not force and entry is not None and
+                entry['hash'] == hashes.get(name) and os.path.isdir(store)):
+            continue
+        try:
+            os.makedirs(os.path.dirname(store), exist_ok=True)
+            convert(gdf.get(name), store)
+        except Exception as err:
+            index.pop(name, None)
+            errors[name] = f'{type(err).__name__}: {err}'
+            continue
+        index[name] = {
+            'hash': hashes.get(name),
+            'store': os.path.relpath(store, store_dir)
+        }
+
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, INDEX), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    return errors
+
+
+class ZarrRedirect:
+    """Replacement of ``xarray.open_dataset`` reading the converted stores.
+
+    Args:
+        store_dir (:class:`str`):
+            Directory written by :func:`convert_datafiles`.
+        open_dataset (:class:`callable`):
+            Function opening the files that have no up-to-date store, the
+            current ``xarray.open_dataset`` by default.
+    """
+
+    def __init__(self, store_dir, open_dataset=None):
+        self._open_dataset = open_dataset or xr.open_dataset
+        hashes = registry()
+        root = cache_root()
+        self.stores = {}
+        for name, entry in _read_index(store_dir).items():
+            store = os.path.join(store_dir, entry['store'])
+            if entry['hash'] == hashes.get(name) and os.path.isdir(store):
+                self.stores[os.path.abspath(os.path.join(root, name))] = store
+
+    def __len__(self):
+        return len(self.stores)
+
+    def open_dataset(self, filename_or_obj, **kwargs):
+        """Open the converted store of ``filename_or_obj`` if there is one."""
+        if (isinstance(filename_or_obj, (str, os.PathLike)) and
+                set(kwargs) <= ZARR_OPTIONS):
+            store = self.stores.get(os.path.abspath(filename_or_obj))
+            if store is not None:
+                # chunks=None reads lazily without dask, one chunk at a time
+                return xr.open_zarr(store, chunks=None, **kwargs)
+        return self._open_dataset(filename_or_obj, **kwargs)
+
+    def install(self):
+        """Make ``xarray.open_dataset`` (as called by the examples) use the
+        converted stores."""
+        xr.open_dataset = self.open_dataset
+
+
+def install(app):
+    """Sphinx ``builder-inited`` handler redirecting the examples' reads."""
+    from sphinx.util import logging
+
+    logger = logging.getLogger(__name__)
+    if not app.config.gallery_zarr_store:
+        return
+    store_dir = os.path.join(app.srcdir, app.config.gallery_zarr_store)
+    if not os.path.exists(os.path.join(store_dir, INDEX)):
+        return
+    try:
+        import zarr  # noqa: F401
+    except ImportError:
+        logger.warning('gallery_zarr_store requires the zarr package')
+        return
+
+    redirect = ZarrRedirect(store_dir)
+    redirect.install()
+    logger.info(f'reading {len(redirect)} gallery data files from {store_dir}')
+
+
+def setup(app):
+    app.add_config_value('gallery_zarr_store', '', '')
+
+    # Install after the prefetch (priority 300) and before the gallery runner
+    # (400) forks its workers and sphinx-gallery (500) executes the examples
+    app.connect('builder-inited', install, priority=350)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert the NetCDF files used by the gallery examples '
+        'into chunked Zarr stores.')
+    parser.add_argument('names',
+                        nargs='*',
+                        help='data files to convert (default: every NetCDF '
+                        'file referenced by the examples)')
+    parser.add_argument('--examples-dir', default='Plots')
+    parser.add_argument('--store', default=STORE)
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='convert files that are already up to date')
+    args = parser.parse_args(argv)
+
+    names = args.names or collect_datafiles(args.examples_dir)
+    errors = convert_datafiles(names, args.store, args.force)
+    for name, error in sorted(errors.items()):
+        print(f'{name}: {error}', file=sys.stderr)
+    print(f'{len(_read_index(args.store))} data files converted in '
+          f'{args.store}')
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
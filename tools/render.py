@@ -0,0 +1,598 @@
+"""
+Render cache of the figure backgrounds shared by the gallery figures.
+
+Several examples draw the same base map more than once and only change what
+is drawn on top of it, e.g. ``make_base_plot()`` in ``NCL_polyg_4.py`` or
+``make_shared_plot()`` in ``NCL_station_2.py``.  :class:`RenderScraper`,
+selected with ``GALLERY_SCRAPER=render`` in ``conf.py``, replaces the
+matplotlib image scraper of sphinx-gallery and rasterizes such figures in two
+layers:
+
+    - the *background*, i.e. the longest prefix of the figure's draw order
+      (figure patch, then every axes with its children sorted by zorder)
+      that another figure already drew identically, is read from
+      :class:`BackgroundCache`, or rendered once and stored there;
+    - the remaining *overlay* artists are rendered alone on a transparent
+      canvas and alpha-composited onto the background.
+
+Artists are identified by a specification hash computed from their data and
+drawing parameters (paths, offsets, colors, line styles, text, fonts, zorder,
+transform of reference points...), so two figures share a background only if
+it would be drawn identically.  Artist types without a specification (e.g.
+legends), with properties the specification does not capture (custom dash
+patterns, path effects, wrapped text) or created only at draw time (cartopy
+gridliners) end the part of a figure that can be cached; figures with no
+shared background are rendered in one pass, exactly like the matplotlib
+scraper.  The matplotlib and FreeType versions are part of every hash, so
+that stored backgrounds are not reused after an upgrade.
+
+Backgrounds are stored as ``.npy`` RGBA buffers that are memory-mapped when
+read, so they are shared by all the processes of a parallel build and reused
+by later builds.
+
+:class:`BatchScraper` builds on this rendering to write every output of a
+figure (PNG and WebP images, a low resolution copy downscaled from the same
+buffer and an optional vector PDF) from a single rasterization, encoding
+them in parallel threads.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+# Number of figures of the current process whose draw orders are compared
+# with the next figures to find shared backgrounds
+SEEN_FIGURES = 20
+
+# Shortest shared prefix (figure patch, axes patch and one more artist)
+# worth storing as a background
+MIN_BACKGROUND = 3
+
+# Points whose transformed coordinates identify an artist's transform
+_REFERENCE_POINTS = np.array([[0.0, 0.0], [1.0, 1.0], [0.25, 0.75]])
+
+
+class Unspecified(Exception):
+    """Raised for artists whose specification cannot be computed."""
+
+
+def _describe(value, digest):
+    """Feed a canonical encoding of ``value`` to the ``digest``."""
+    from matplotlib.colors import Colormap
+    from matplotlib.path import Path
+
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        digest.update(repr(value).encode())
+    elif isinstance(value, np.ma.MaskedArray):
+        _describe((value.filled(0), np.ma.getmaskarray(value)), digest)
+    elif isinstance(value, np.ndarray):
+        if value.dtype == object:
+            for item in value.flat:
+                _describe(item, digest)
+        else:
+            array = np.ascontiguousarray(value)
+            digest.update(f'{array.dtype.str}{array.shape}'.encode())
+            digest.update(array.tobytes())
+    elif isinstance(value, np.generic):
+        digest.update(repr(value.item()).encode())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'[{len(value)}'.encode())
+        for item in value:
+            _describe(item, digest)
+        digest.update(b']')
+    elif isinstance(value, dict):
+        _describe(sorted(value.items(), key=lambda item: str(item[0])), digest)
+    elif isinstance(value, Path):
+        _describe((value.vertices, value.codes), digest)
+    elif isinstance(value, Colormap):
+        _describe((value(np.linspace(0, 1, value.N)), value(-np.inf),
+                   value(np.inf), value(np.nan)), digest)
+    else:
+        raise Unspecified(type(value).__name__)
+
+
+def _transform_spec(transform):
+    try:
+        return transform.transform(_REFERENCE_POINTS)
+    except Exception as err:
+        raise Unspecified(f'transform: {err}')
+
+
+def _font_spec(text):
+    font = text.get_fontproperties()
+    return (font.get_family(), font.get_style(), font.get_weight(),
+            font.get_size_in_points(), font.get_stretch(), font.get_file())
+
+
+def _style_spec(style):
+    # Box and arrow styles are plain objects holding their parameters
+    return (type(style).__name__, vars(style)) if style is not None else None
+
+
+def _text_spec(text):
+    if text.get_wrap():
+        raise Unspecified('wrapped text')
+    bbox = text.get_bbox_patch()
+    return (text.get_text(), text.get_position(),
+            _transform_spec(text.get_transform()), _font_spec(text),
+            text.get_color(), text.get_rotation(),
+            text.get_horizontalalignment(), text.get_verticalalignment(),
+            text._multialignment, text.get_linespacing(),
+            text.get_rotation_mode(), text.get_usetex(),
+            _patch_spec(bbox) if bbox is not None else None)
+
+
+def _patch_spec(patch):
+    from matplotlib.patches import FancyBboxPatch
+
+    spec = (patch.get_path(), _transform_spec(patch.get_transform()),
+            patch.get_facecolor(), patch.get_edgecolor(),
+            patch.get_linewidth(), patch.get_linestyle(), patch.get_hatch(),
+            patch.get_fill(), patch.get_joinstyle(), patch.get_capstyle())
+    if isinstance(patch, FancyBboxPatch):
+        spec += (_style_spec(patch.get_boxstyle()), patch.get_mutation_scale(),
+                 patch.get_mutation_aspect())
+    return spec
+
+
+def _dash_pattern(line):
+    # get_linestyle() reports any custom dash pattern as '--', so the
+    # unscaled pattern is read from the attributes set_linestyle() stores
+    if hasattr(line, '_unscaled_dash_pattern'):
+        offset, dashes = line._unscaled_dash_pattern
+    elif hasattr(line, '_us_dashSeq'):
+        offset, dashes = line._us_dashOffset, line._us_dashSeq
+    else:
+        raise Unspecified('dash pattern')
+    return offset, None if dashes is None else list(dashes)
+
+
+def _line_spec(line):
+    from matplotlib.lines import _get_dash_pattern
+
+    style = line.get_linestyle()
+    if style not in ('-', 'None', ' ', ''):
+        offset, dashes = _get_dash_pattern(style)
+        if _dash_pattern(line) != (offset, list(dashes)):
+            raise Unspecified('custom dash pattern')
+    return (line.get_xydata(), _transform_spec(line.get_transform()),
+            line.get_color(), line.get_linewidth(), line.get_linestyle(),
+            line.get_drawstyle(), line.get_marker(), line.get_markersize(),
+            line.get_markerfacecolor(), line.get_markeredgecolor(),
+            line.get_markeredgewidth(), line.get_fillstyle(),
+            line.get_markevery(), line.get_dash_capstyle(),
+            line.get_solid_capstyle())
+
+
+def _mappable_spec(mappable):
+    norm = mappable.norm
+    return (mappable.get_array(), mappable.get_cmap(), type(norm).__name__,
+            norm.vmin, norm.vmax, getattr(norm, 'boundaries', None))
+
+
+def _collection_spec(collection):
+    spec = (collection.get_paths(),
+            _transform_spec(collection.get_transform()),
+            collection.get_offsets(),
+            _transform_spec(collection.get_offset_transform()),
+            collection.get_facecolor(), collection.get_edgecolor(),
+            collection.get_linewidth(), collection.get_linestyle(),
+            collection.get_hatch(), collection.get_antialiased(),
+            _mappable_spec(collection))
+    if hasattr(collection, 'get_sizes'):
+        spec += (collection.get_sizes(),)
+    return spec
+
+
+def _image_spec(image):
+    return (image.get_array(), _mappable_spec(image), image.get_extent(),
+            image.get_interpolation(), image.origin,
+            _transform_spec(image.get_transform()))
+
+
+def _axis_spec(axis):
+    ticks = axis._update_ticks()  # also formats the tick labels
+    return (axis.label.get_visible() and _text_spec(axis.label), [
+        (tick.get_loc(), tick.tick1line.get_visible() and
+         _line_spec(tick.tick1line), tick.tick2line.get_visible() and
+         _line_spec(tick.tick2line), tick.gridline.get_visible() and
+         _line_spec(tick.gridline), tick.label1.get_visible() and
+         _text_spec(tick.label1), tick.label2.get_visible() and
+         _text_spec(tick.label2)) for tick in ticks
+    ])
+
+
+def _spine_spec(spine):
+    return _patch_spec(spine) + (spine.spine_type, spine.get_position())
+
+
+def _feature_spec(artist):
+    """Specification of a cartopy ``FeatureArtist``."""
+    feature = artist._feature
+    if all(hasattr(feature, name) for name in ('category', 'name', 'scale')):
+        geometries = (feature.category, feature.name, feature.scale)
+    else:
+        geometries = [geometry.wkb for geometry in feature.geometries()]
+    return (type(feature).__name__, geometries, feature.kwargs,
+            artist._kwargs, _transform_spec(artist.axes.transData),
+            tuple(artist.axes.get_extent()))
+
+
+def artist_spec(artist):
+    """Return the specification hash of an artist.
+
+    Raises:
+        :class:`Unspecified`: the artist type or one of its properties is
+            not supported.
+    """
+    from matplotlib.axis import Axis
+    from matplotlib.collections import Collection
+    from matplotlib.image import AxesImage
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Patch
+    from matplotlib.spines import Spine
+    from matplotlib.text import Text
+
+    if isinstance(artist, Spine):
+        spec = _spine_spec(artist)
+    elif isinstance(artist, Text):
+        spec = _text_spec(artist)
+    elif isinstance(artist, Patch):
+        spec = _patch_spec(artist)
+    elif isinstance(artist, Line2D):
+        spec = _line_spec(artist)
+    elif isinstance(artist, Collection):
+        spec = _collection_spec(artist)
+    elif isinstance(artist, AxesImage):
+        spec = _image_spec(artist)
+    elif isinstance(artist, Axis):
+        spec = _axis_spec(artist)
+    elif type(artist).__name__ == 'FeatureArtist':
+        spec = _feature_spec(artist)
+    else:
+        raise Unspecified(type(artist).__name__)
+    if artist.get_path_effects():
+        raise Unspecified('path effects')
+
+    clip_box = artist.get_clip_box()
+    clip_path = artist.get_clip_path()
+    if clip_path is not None:
+        path, transform = clip_path.get_transformed_path_and_affine()
+        clip_path = (path, _transform_spec(transform))
+
+    digest = hashlib.sha256(type(artist).__name__.encode())
+    _describe(
+        (spec, artist.get_zorder(), artist.get_alpha(), artist.get_clip_on(),
+         clip_box.bounds if clip_box is not None else None, clip_path,
+         artist.get_rasterized(), artist.get_agg_filter() is not None), digest)
+    return digest.hexdigest()
+
+
+def draw_order(fig):
+    """Return the visible artists of a figure in the order Agg draws them."""
+    from matplotlib.axes import Axes
+
+    def by_zorder(artists):
+        # sorted() is stable, like the sorting done by matplotlib
+        return sorted((artist for artist in artists if artist.get_visible()),
+                      key=lambda artist: artist.get_zorder())
+
+    order = [fig.patch]
+    for child in by_zorder(child for child in fig.get_children()
+                           if child is not fig.patch):
+        if not isinstance(child, Axes):
+            order.append(child)
+            continue
+        if getattr(child, '_gridliners', None):
+            # Cartopy creates the gridliner lines and labels while drawing,
+            # so the artists listed here do not cover the axes: the axes
+            # itself, which has no specification, ends the cached prefix
+            order.append(child)
+        # Axes.draw skips the spines unless both the axis and the frame are on
+        excluded = {child.patch}
+        if not (child.axison and child.get_frame_on()):
+            excluded.update(child.spines.values())
+        if not child.axison:
+            excluded.update((child.xaxis, child.yaxis))
+        if child.axison and child.get_frame_on():
+            order.append(child.patch)
+        order.extend(by_zorder(artist for artist in child.get_children()
+                               if artist not in excluded))
+    return [artist for artist in order if artist.get_visible()]
+
+
+def prefix_hashes(fig, order):
+    """Return the hashes identifying the prefixes of a draw order.
+
+    The hash of prefix ``k`` covers the matplotlib and FreeType versions,
+    the canvas size and the specifications of the first ``k`` artists; the
+    list stops at the first artist without a specification.
+    """
+    import matplotlib
+    from matplotlib import ft2font
+
+    width, height = fig.canvas.get_width_height()
+    digest = hashlib.sha256(
+        f'{matplotlib.__version__}/{ft2font.__freetype_version__}/'
+        f'{width}x{height}@{fig.dpi}'.encode())
+    hashes = []
+    for artist in order:
+        try:
+            digest.update(artist_spec(artist).encode())
+        except Unspecified:
+            break
+        hashes.append(digest.copy().hexdigest())
+    return hashes
+
+
+def _common_prefix(hashes, other):
+    length = 0
+    for this, that in zip(hashes, other):
+        if this != that:
+            break
+        length += 1
+    return length
+
+
+def _draw(fig, hidden):
+    """Draw ``fig`` on its Agg canvas without the ``hidden`` artists and
+    return a copy of the RGBA buffer."""
+    visible = [artist.get_visible() for artist in hidden]
+    for artist in hidden:
+        artist.set_visible(False)
+    try:
+        fig.canvas.draw()
+        return np.array(fig.canvas.buffer_rgba())
+    finally:
+        for artist, was_visible in zip(hidden, visible):
+            artist.set_visible(was_visible)
+
+
+def composite(background, overlay):
+    """Alpha-composite the RGBA ``overlay`` over the RGBA ``background``."""
+    over = overlay.astype(np.float32) / 255
+    under = background.astype(np.float32) / 255
+    over_alpha = over[..., 3:]
+    under_alpha = under[..., 3:] * (1 - over_alpha)
+    alpha = over_alpha + under_alpha
+    rgb = (over[..., :3] * over_alpha + under[..., :3] * under_alpha)
+    rgb = np.divide(rgb, alpha, out=np.zeros_like(rgb), where=alpha > 0)
+    out = np.concatenate([rgb, alpha], axis=-1)
+    return np.round(out * 255).astype(np.uint8)
+
+
+class BackgroundCache:
+    """Directory of rendered backgrounds, stored as memory-mapped RGBA
+    ``.npy`` buffers named after their prefix hash.
+
+    Args:
+        cache_dir (:class:`str`):
+            Directory holding the backgrounds.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """Return the memory-mapped background ``key``, or None."""
+        try:
+            return np.load(self.path(key), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, rgba):
+        """Store the RGBA buffer ``rgba`` as background ``key``."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it, so that concurrent
+        # workers never read a partial buffer
+        fd, partial = tempfile.mkstemp(suffix='.npy',
+                                       dir=os.path.dirname(path))
+        os.close(fd)
+        buffer = np.lib.format.open_memmap(partial,
+                                           mode='w+',
+                                           dtype=np.uint8,
+                                           shape=rgba.shape)
+        buffer[...] = rgba
+        buffer.flush()
+        del buffer
+        os.replace(partial, path)
+
+
+class RenderScraper:
+    """Sphinx-gallery image scraper rendering matplotlib figures through a
+    :class:`BackgroundCache`.
+
+    Args:
+        cache_dir (:class:`str`):
+            Directory of the background cache, or None to render every figure
+            in one pass without it.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._seen = []
+
+    def __repr__(self):
+        # sphinx-gallery includes the scrapers in the configuration it
+        # compares between builds; keep the representation stable
+        return f'{type(self).__name__}({self.cache_dir!r})'
+
+    def render(self, fig):
+        """Return the RGBA rendering of ``fig``."""
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        if not isinstance(fig.canvas, FigureCanvasAgg):
+            FigureCanvasAgg(fig)
+        if self.cache_dir is None:
+            return _draw(fig, [])
+        if fig.get_constrained_layout():
+            # Lay out once with every artist visible, then keep the layout
+            # while parts of the figure are hidden
+            fig.execute_constrained_layout()
+            fig.set_constrained_layout(False)
+        for ax in fig.axes:
+            ax.apply_aspect()
+
+        order = draw_order(fig)
+        hashes = prefix_hashes(fig, order)
+        cache = BackgroundCache(self.cache_dir)
+
+        # Longest background available in the cache...
+        length, background = 0, None
+        for prefix in range(len(hashes), MIN_BACKGROUND - 1, -1):
+            background = cache.get(hashes[prefix - 1])
+            if background is not None:
+                length = prefix
+                break
+        else:
+            # ... or shared with a figure rendered before by this process
+            shared = max((_common_prefix(hashes, other) for other in self._seen),
+                         default=0)
+            if shared >= MIN_BACKGROUND:
+                length = shared
+                background = _draw(fig, order[length:])
+                cache.put(hashes[length - 1], background)
+
+        self._seen = (self._seen + [hashes])[-SEEN_FIGURES:]
+        if background is None:
+            return _draw(fig, [])
+        if length == len(order):
+            return np.array(background)
+        overlay = _draw(fig, order[:length])
+        return composite(background, overlay)
+
+    def __call__(self, block, block_vars, gallery_conf):
+        import matplotlib.pyplot as plt
+        from PIL import Image
+        from sphinx_gallery.scrapers import figure_rst
+
+        image_paths = []
+        for fig_num, image_path in zip(plt.get_fignums(),
+                                       block_vars['image_path_iterator']):
+            fig = plt.figure(fig_num)
+            try:
+                rgba = self.render(fig)
+            except Exception:
+                # Never lose a figure to the cache; save it the usual way
+                fig.savefig(image_path, dpi=fig.dpi)
+            else:
+                Image.fromarray(rgba).save(image_path)
+            image_paths.append(image_path)
+        plt.close('all')
+        return figure_rst(image_paths, gallery_conf['src_dir'])
+
+
+class BatchScraper(RenderScraper):
+    """Image scraper rendering every figure once and writing all its outputs
+    from that single rendering.
+
+    The rendered buffer is encoded in every raster format, downscaled into a
+    low resolution copy and, optionally, complemented by a vector PDF; the
+    encoders run in a thread pool while the next figure is rendered.
+
+    Args:
+        cache_dir (:class:`str`):
+            Directory of the background cache, or None to render every figure
+            in one pass without it.
+        formats (:class:`tuple`):
+            Output formats among ``'png'`` and ``'webp'``, written at the
+            figure resolution, and ``'pdf'``, a vector copy offered as a
+            download below the figures.  The gallery pages show the first
+            raster format.  PNG is always written, since sphinx-gallery makes
+            the example thumbnails from it.
+        small_dpi (:class:`int`):
+            Resolution of the low resolution copy of every figure
+            (``sphx_glr_<example>_<number>_small.png``), downscaled from the
+            rendered buffer; 0 disables it.
+        jobs (:class:`int`):
+            Number of threads encoding the images.
+    """
+
+    def __init__(self, cache_dir, formats=('png',), small_dpi=0, jobs=4):
+        super().__init__(cache_dir)
+        unknown = set(formats) - {'png', 'webp', 'pdf'}
+        if unknown:
+            raise ValueError(f'unsupported image formats: {sorted(unknown)}')
+        self.formats = tuple(formats)
+        self.raster_formats = tuple(
+            fmt for fmt in self.formats if fmt != 'pdf') or ('png',)
+        self.pdf = 'pdf' in self.formats
+        self.small_dpi = small_dpi
+        self.jobs = jobs
+
+    def __repr__(self):
+        return (f'{type(self).__name__}({self.cache_dir!r}, '
+                f'formats={self.formats!r}, small_dpi={self.small_dpi!r}, '
+                f'jobs={self.jobs!r})')
+
+    def _encode(self, rgba, image_path, dpi):
+        """Write the raster outputs of one figure from its RGBA buffer."""
+        from PIL import Image
+
+        image = Image.fromarray(rgba)
+        stem = os.path.splitext(image_path)[0]
+        image.save(image_path)
+        if 'webp' in self.raster_formats:
+            image.save(stem + '.webp', quality=90, method=4)
+        if self.small_dpi:
+            scale = self.small_dpi / dpi
+            size = (max(1, round(image.width * scale)),
+                    max(1, round(image.height * scale)))
+            image.resize(size, Image.LANCZOS).save(stem + '_small.png')
+
+    def __call__(self, block, block_vars, gallery_conf):
+        import concurrent.futures
+
+        import matplotlib.pyplot as plt
+        from PIL import Image
+        from sphinx_gallery.scrapers import figure_rst
+
+        image_paths = []
+        pdf_paths = []
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            encoders = []
+            for fig_num, image_path in zip(plt.get_fignums(),
+                                           block_vars['image_path_iterator']):
+                fig = plt.figure(fig_num)
+                try:
+                    rgba = self.render(fig)
+                except Exception:
+                    # Never lose a figure to the cache; save it the usual way
+                    # and derive the other outputs from that image
+                    fig.savefig(image_path, dpi=fig.dpi)
+                    rgba = np.asarray(Image.open(image_path).convert('RGBA'))
+                encoders.append(
+                    executor.submit(self._encode, rgba, image_path, fig.dpi))
+                image_paths.append(image_path)
+
+                # Vector output is drawn again by the PDF backend, in this
+                # thread, while the raster images are being encoded
+                if self.pdf:
+                    pdf_paths.append(os.path.splitext(image_path)[0] + '.pdf')
+                    fig.savefig(pdf_paths[-1], format='pdf')
+            for encoder in encoders:
+                encoder.result()
+        plt.close('all')
+
+        shown = [
+            os.path.splitext(image_path)[0] + '.' + self.raster_formats[0]
+            for image_path in image_paths
+        ]
+        rst = figure_rst(shown, gallery_conf['src_dir'])
+        if pdf_paths:
+            downloads = ', '.join(
+                f':download:`figure {number} (PDF) </' +
+                os.path.relpath(pdf_path, gallery_conf['src_dir']).replace(
+                    os.sep, '/') + '>`'
+                for number, pdf_path in enumerate(pdf_paths, 1))
+            rst += f'\nVector versions: {downloads}\n'
+        return rst